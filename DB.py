@@ -1,11 +1,27 @@
+import threading
 from typing import Optional
 
+from content_index import ContentIndex
+from rendition_cache import RenditionCache
 from search_lib import CompactingIndexer
 from table_manager import TableManager, TableM2
+from vector_index import VectorIndex
+from wal import WriteAheadLog
 
 # tbm = TableManager("testfile/test-imgrepo.db")
-tbm = TableM2("testfile/test-imgrepo.db")
+WAL = WriteAheadLog("testfile/wal.log")
+tbm = TableM2("testfile/test-imgrepo.db", "testfile/catalog.json", WAL)
 SEARCH: Optional[CompactingIndexer] = None
+# sha256 -> id of uploaded images, loaded by init_search
+CONTENT: Optional[ContentIndex] = None
+# Image embeddings for mode=vector searches, created by init_search
+VECTORS: Optional[VectorIndex] = None
+# Serializes writers across the table, the search index and the WAL, so a checkpoint never truncates a write that
+# has reached the log but not yet the flushed index.
+WRITER = threading.RLock()
+# ingest.IngestPipeline, created by init_search. Not imported here, it depends on picture which imports DB.
+INGEST = None
+RENDITIONS = RenditionCache("testfile/renditions")
 
 
 def reset_tables():
@@ -1,14 +1,21 @@
 import io
-import json
+import os
 
 import flask
 from flask import Blueprint, request
 
 import DB
-from picture import post_picture, generate_thumbnail, generate_most_similar
+import metrics
+from picture import post_picture, generate_thumbnail, tag_image, index_synonyms_batch, generate_rendition, \
+    RENDITION_SIZES, WEBP_SUPPORTED, NEIGHBOURS, find_duplicate, post_duplicate, index_text
+from rendition_cache import RenditionCache
+from table_manager import METADATA_COLUMNS, CONTENTS_COLUMNS
 
 api = Blueprint("api", __name__)
 
+# Image responses are immutable for a given ETag
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
 
 @api.route("/post-picture-simple", methods=["POST"])
 def store_to_db_simple():
@@ -17,6 +24,7 @@ def store_to_db_simple():
     id = post_picture(
         file_stream.read(), description, file_stream.filename, file_stream.mimetype
     )
+    commit_writes()
 
     return id, 200
 
@@ -24,22 +32,68 @@ def store_to_db_simple():
 @api.route("/img_data")
 def img_data():
     id: int = int(request.args["id"])
-    result = DB.tbm.get(id)
+    size = request.args.get("size", "full")
+    if size != "full" and size not in RENDITION_SIZES:
+        return "Unknown image size", 400
+    fmt = "webp" if size != "full" and WEBP_SUPPORTED and request.accept_mimetypes["image/webp"] else "jpeg"
+
+    # Metadata only, revalidations never read the image itself.
+    result = DB.tbm.get(id, METADATA_COLUMNS)
     if result is None:
         print("Image not found!", id)
         return "Image file not found", 400
 
-    db_data = json.loads(result.description)
-
+    db_data = result.metadata
     if db_data is None:
         print("Image has been deleted!", id, result)
         return "Image has been deleted", 400
 
-    return flask.send_file(
-        io.BytesIO(result.data),
-        attachment_filename=db_data["filename"],
-        mimetype=db_data["mimetype"],
-    )
+    etag = image_etag(id, db_data, size, fmt)
+    if etag in request.if_none_match:
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        set_cache_headers(response, size)
+        return response
+
+    # Duplicate uploads point at the row that holds the bytes.
+    blob_id = db_data.get("blob", id)
+    if size != "full":
+        key = RenditionCache.key(blob_id, size, fmt)
+        rendition = DB.RENDITIONS.get(key)
+        if rendition is None:
+            rendition = generate_rendition(DB.tbm.get(blob_id, CONTENTS_COLUMNS).data, size, fmt)
+            DB.RENDITIONS.put(key, rendition)
+        response = flask.send_file(io.BytesIO(rendition), mimetype=f"image/{fmt}", etag=etag)
+    else:
+        # conditional=True answers Range requests from the buffer
+        response = flask.send_file(
+            io.BytesIO(DB.tbm.get(blob_id, CONTENTS_COLUMNS).data),
+            attachment_filename=db_data["filename"],
+            mimetype=db_data["mimetype"],
+            conditional=True,
+            etag=etag,
+        )
+        response.accept_ranges = "bytes"
+    set_cache_headers(response, size)
+    return response
+
+
+def image_etag(id: int, db_data: dict, size: str, fmt: str) -> str:
+    # Ids are never reused and images never change in place, so id + content hash identifies the bytes. Images stored
+    # before the hash was recorded fall back to the id.
+    version = f"{id}-{db_data['sha256'][0:16]}" if "sha256" in db_data else str(id)
+    if size == "full":
+        return version
+    return f"{version}-{size}.{fmt}"
+
+
+def set_cache_headers(response: flask.Response, size: str):
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    response.cache_control.immutable = True
+    response.cache_control.no_cache = None
+    if size != "full":
+        response.vary.add("Accept")
 
 
 @api.route("/post-picture", methods=["POST"])
@@ -49,47 +103,140 @@ def post_picture_web():
         file_contents = file_stream.read()
         if len(file_contents) == 0:
             continue
+        original = find_duplicate(file_contents)
+        if original is not None:
+            id = post_duplicate(original, file_stream.filename, file_stream.mimetype)
+            response += f"Posted picture {file_stream.filename} to {id}<br><br>"
+            continue
         thumbnail = generate_thumbnail(file_contents)
-        tags = generate_most_similar(thumbnail)
-        document_str = " ".join(tags)
+        tags = tag_image(thumbnail)
+        document_str = " ".join(index_synonyms_batch([tags])[0] + tags)
 
         print("Picture descr", document_str)
         id = post_picture(
-            file_contents, document_str, file_stream.filename, file_stream.mimetype
+            file_contents, document_str, file_stream.filename, file_stream.mimetype, tags
         )
         response += f"Posted picture {file_stream.filename} to {id}<br><br>"
 
-    print("auto flushing")
-    flush_search()
+    commit_writes(force_flush="flush" in request.form)
     return flask.redirect(flask.url_for('public.all_pictures'))
 
 
+@api.route("/post-picture-async", methods=["POST"])
+def post_picture_async():
+    files = []
+    for file_stream in request.files.getlist("file"):
+        file_contents = file_stream.read()
+        if len(file_contents) == 0:
+            continue
+        files.append((file_contents, file_stream.filename, file_stream.mimetype))
+
+    job = DB.INGEST.submit(files, flush="flush" in request.form)
+    return flask.jsonify(job=job.id, status=flask.url_for("api.ingest_status", job=job.id)), 202
+
+
+@api.route("/ingest-status")
+def ingest_status():
+    job = DB.INGEST.status(request.args["job"])
+    if job is None:
+        return "Job not found", 404
+    return flask.jsonify(job.to_json())
+
+
 @api.route("/delete")
 def delete_image():
     id = int(request.args["id"])
     print("Deleting image ", id)
-    DB.tbm.store(id, "deleted.jpg", "null", b"blank image")
-    flush_db()
+    with DB.WRITER:
+        # An unassigned id would raise the catalog's max id past the index's and tombstone the next upload.
+        if id > DB.SEARCH.id_count() or DB.tbm.get(id, METADATA_COLUMNS) is None:
+            return "Image file not found", 404
+        DB.CONTENT.remove_copy(id)
+        data = b"blank image"
+        if DB.CONTENT.has_copies(id):
+            # Live duplicates point at these bytes, so they stay in the deleted row. Compaction drops them once no live
+            # row does.
+            doc = DB.tbm.get(id, CONTENTS_COLUMNS)
+            data = doc.data if doc else data
+        DB.tbm.store(id, "deleted.jpg", "null", data)
+        DB.SEARCH.delete(id)
+        DB.VECTORS.remove(id)
+        DB.RENDITIONS.invalidate(id)
+    commit_writes()
     return flask.redirect(flask.url_for('public.all_pictures'))
 
 
-def flush_db():
-    DB.tbm.flush()
+def commit_writes(force_flush=False):
+    # Requests only wait for the WAL append to be durable, the table and index flush when the log grows large or old.
+    DB.WAL.commit()
+    if force_flush or DB.WAL.should_checkpoint():
+        print("auto flushing")
+        flush_search()
 
 
 @api.route("/flush-search")
 def flush_search():
-    DB.SEARCH.flush()
-    DB.tbm.flush()
-    # DB.tbm.compact()
+    with DB.WRITER:
+        DB.SEARCH.flush()
+        DB.tbm.flush()
+        DB.CONTENT.flush()
+        DB.VECTORS.flush()
+        DB.WAL.checkpoint()
+    NEIGHBOURS.save()
+    return "", 200
+
+
+@api.route("/compact")
+def compact():
+    compact_storage()
     return "", 200
 
 
+def compact_storage(workers=None, backend="thread"):
+    # Rewrites the table without deleted images, then rebuilds the index from what's left, which purges the tombstones.
+    with DB.WRITER:
+        flush_search()
+        DB.tbm.compact()
+        DB.SEARCH.rebuild(live_documents(), workers or os.cpu_count(), backend, DB.tbm.catalog.row_count)
+
+
+def live_documents():
+    # id and desc only, the blobs are never read
+    for doc in DB.tbm.select(0b0101):
+        if doc.metadata:
+            yield index_text(doc.metadata), doc.id
+
+
+@api.route("/cache-stats")
+def cache_stats():
+    return flask.jsonify(
+        queries=DB.SEARCH.cache.stats(),
+        renditions=DB.RENDITIONS.stats(),
+        neighbours=NEIGHBOURS.stats(),
+    )
+
+
+@api.route("/metrics")
+def metrics_text():
+    query_cache = DB.SEARCH.cache.stats()
+    renditions = DB.RENDITIONS.stats()
+    extra = (
+        metrics.gauge("imgrepo_segments", "Search index segments", len(DB.SEARCH.segments))
+        + metrics.gauge("imgrepo_tombstones", "Deleted images not yet purged", DB.SEARCH.tombstones.count)
+        + metrics.gauge("imgrepo_vectors", "Images in the vector index", len(DB.VECTORS))
+        + metrics.counter("imgrepo_query_cache_hits_total", "Query cache hits", query_cache["hits"])
+        + metrics.counter("imgrepo_query_cache_misses_total", "Query cache misses", query_cache["misses"])
+        + metrics.counter("imgrepo_rendition_cache_hits_total", "Rendition cache hits", renditions["hits"])
+        + metrics.counter("imgrepo_rendition_cache_misses_total", "Rendition cache misses", renditions["misses"])
+    )
+    return flask.Response(metrics.render(extra), mimetype="text/plain; version=0.0.4")
+
+
 @api.route("/img_name")
 def img_by_name():
     print("Doing img name")
     name = request.args["name"]
-    resps = DB.tbm.get_by_name(name)
+    resps = DB.tbm.get_by_name(name, METADATA_COLUMNS)
     urls = []
     for resp in resps:
         urls.append((resp.id, resp.filename))
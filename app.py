@@ -1,35 +1,139 @@
+import glob
+import json
 import os
+import shutil
 
-from flask import Flask
+from flask import Flask, request
 
 import DB
+from catalog import Catalog
+from content_index import ContentIndex
 import tests
-from api import api
+from api import api, commit_writes
+from ingest import IngestPipeline
 from main import public
-from search_lib import CompactingIndexer
+from metrics import SlowRequestLog
+import picture
+from picture import MODEL, embed_tags, expand_query
+from rendition_cache import RenditionCache
+from search_lib import CompactingIndexer, INDEX_DIR, INDEX_FILES, TOMBSTONES_PATH
+from tombstones import Tombstones
+from vector_index import VectorIndex
+from wal import RECORD_STORE, RECORD_INDEX
+
+CONTENT_INDEX_PATH = "testfile/content-index.log"
+VECTORS_PATH = f"{INDEX_DIR}/vectors"
 
 
 def remove_files_from_previous():
+    if DB.SEARCH is not None:
+        # No merge may be reading the segment files removed below.
+        DB.SEARCH.close()
     try:
         os.remove("testfile/test-imgrepo.db")
-        os.remove("testfile/frequencies-main")
-        os.remove("testfile/terms-main")
-        os.remove("testfile/positions-main")
+        os.remove("testfile/catalog.json")
     except FileNotFoundError:
         pass
+    Tombstones(TOMBSTONES_PATH).persist()
+    if DB.CONTENT:
+        DB.CONTENT.clear()
+    for f in INDEX_FILES:
+        for path in glob.glob(f"{INDEX_DIR}/{f}-*"):
+            os.remove(path)
+    for path in glob.glob(f"{VECTORS_PATH}*"):
+        os.remove(path)
+    shutil.rmtree("testfile/renditions", ignore_errors=True)
+    DB.RENDITIONS = RenditionCache("testfile/renditions")
+    DB.tbm.catalog = Catalog(DB.tbm.catalog_path)
+    DB.WAL.checkpoint()
 
 
 def init_search():
-    max_key = len(DB.tbm.exec_sql("SELECT * FROM images"))
-    print("Max key: ", max_key)
-    if os.path.exists("testfile/frequencies-main"):
+    max_key = DB.tbm.catalog.max_id
+    print("Max key: ", max_key, "generation: ", DB.tbm.catalog.generation)
+    if os.path.exists(f"{INDEX_DIR}/frequencies-main"):
         start_prefix = "main"
     else:
         start_prefix = None
-    DB.SEARCH = CompactingIndexer(max_key, start_prefix)
+    picture.QUERY_EXPANSION = app.config["QUERY_EXPANSION"]
+    # Reads the config on every search, so recall can be tuned without reindexing.
+    query_expander = (lambda terms: expand_query(terms, app.config["QUERY_EXPANSION_TOPN"])) \
+        if app.config["QUERY_EXPANSION"] else None
+    if DB.SEARCH is not None:
+        # reset() and tests call init_search again, the old index's merge thread would keep running.
+        DB.SEARCH.close()
+    DB.SEARCH = CompactingIndexer(max_key, start_prefix, DB.tbm.catalog, DB.WAL, load_tombstones(),
+                                  vectorized=app.config["VECTORIZED_SEARCH"], query_expander=query_expander)
+    DB.CONTENT = load_content_index()
+    DB.VECTORS = VectorIndex(VECTORS_PATH, MODEL.vector_size)
+    replay_wal()
+    if DB.INGEST is None:
+        DB.INGEST = IngestPipeline(
+            app.config["INGEST_CPU_WORKERS"], app.config["INGEST_TAG_WORKERS"],
+            on_job_done=lambda job: commit_writes(force_flush=job.flush)
+        )
     DB.reset_tables()
 
 
+def load_tombstones() -> Tombstones:
+    tombstones = Tombstones.load(TOMBSTONES_PATH)
+    if tombstones is None:
+        # Tables written before the bitmap existed: one scan for rows that were deleted, like the catalog rebuild.
+        print("Rebuilding tombstones")
+        tombstones = Tombstones(TOMBSTONES_PATH)
+        for doc in DB.tbm.select(0b0101):
+            if doc.metadata is None:
+                tombstones.add(doc.id)
+        tombstones.persist()
+    return tombstones
+
+
+def load_content_index() -> ContentIndex:
+    content = ContentIndex.load(CONTENT_INDEX_PATH)
+    if content is None:
+        print("Rebuilding content index")
+        content = ContentIndex(CONTENT_INDEX_PATH)
+        for doc in DB.tbm.select(0b0101):
+            if doc.metadata and "blob" in doc.metadata:
+                content.add_copy(doc.metadata["blob"], doc.id)
+            elif doc.metadata and "sha256" in doc.metadata:
+                content.add(doc.metadata["sha256"], doc.id)
+        content.flush()
+    return content
+
+
+def replay_wal():
+    # Writes since the last checkpoint. They stay in the log until the next flush_search checkpoints it.
+    replayed = 0
+    for kind, record in DB.WAL.replay():
+        if kind == RECORD_STORE:
+            DB.tbm.store(*record, log=False)
+            id, _, description, _ = record
+            db_data = json.loads(description)
+            if db_data is None:
+                DB.SEARCH.delete(id)
+                DB.VECTORS.remove(id)
+                DB.CONTENT.remove_copy(id)
+            else:
+                if "blob" in db_data:
+                    DB.CONTENT.add_copy(db_data["blob"], id)
+                elif "sha256" in db_data:
+                    DB.CONTENT.add(db_data["sha256"], id)
+                vector = embed_tags(db_data["tags"]) if "tags" in db_data else None
+                if vector is not None:
+                    DB.VECTORS.append(id, vector)
+            if id > DB.SEARCH.id_count():
+                # Ids reserved by bulk imports have no index record in the log.
+                DB.SEARCH.reserve_ids(id - DB.SEARCH.id_count())
+        elif kind == RECORD_INDEX:
+            id, contents = record
+            # A crash after the segment was persisted but before the log was truncated leaves both.
+            if id > DB.tbm.catalog.indexed_through:
+                DB.SEARCH.replay_file(contents, id)
+        replayed += 1
+    print("Replayed WAL records: ", replayed)
+
+
 def reset():
     remove_files_from_previous()
     init_search()
@@ -39,8 +143,33 @@ def reset():
 app = Flask(__name__)
 app.config["TESTING"] = True
 app.config["PROPAGATE_EXCEPTIONS"] = True
+app.config["INGEST_CPU_WORKERS"] = os.cpu_count()
+app.config["INGEST_TAG_WORKERS"] = 8
+# Build search results with NumPy over the native buffers (search_lib.ArraySearchRetType)
+app.config["VECTORIZED_SEARCH"] = True
+# Index only the raw tags and expand queries with weighted neighbours instead. Needs a reindex when switched, since
+# the stored descriptions of existing images still contain their synonyms.
+app.config["QUERY_EXPANSION"] = False
+app.config["QUERY_EXPANSION_TOPN"] = 10
+# Requests slower than this are logged to testfile/slow-requests.log with the time spent per stage
+app.config["SLOW_REQUEST_SECONDS"] = 0.5
 app.register_blueprint(public, url_prefix="/")
 app.register_blueprint(api)
+
+SLOW_REQUESTS = SlowRequestLog("testfile/slow-requests.log", app.config["SLOW_REQUEST_SECONDS"])
+
+
+@app.before_request
+def start_request_timing():
+    SLOW_REQUESTS.start_request()
+
+
+@app.after_request
+def finish_request_timing(response):
+    SLOW_REQUESTS.finish_request(request.endpoint, response.status_code, request.full_path)
+    return response
+
+
 #reset()
 #tests.search_image_test(app)
 #reset()
@@ -51,8 +180,23 @@ app.register_blueprint(api)
 #tests.test_delete_image(app)
 #reset()
 #tests.test_persistence(app)
+#reset()
+#tests.table_select_test(app)
+#reset()
+#tests.get_many_test(app)
+#reset()
+#tests.store_many_test(app)
+#reset()
+#tests.test_wal_replay(app, init_search)
+#tests.expansion_test(app)
+#reset()
+#tests.vectorized_search_test(app)
+#reset()
+#tests.http_cache_test(app)
 #
 # init_search()
 # tests.fill_with_images(app)
 init_search()
-app.run(debug=False, threaded=False)
+
+if __name__ == "__main__":
+    app.run(debug=False, threaded=True)
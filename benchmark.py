@@ -0,0 +1,203 @@
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import app
+import metrics
+from picture import MODEL
+
+# Images generated per batch, outside the timed ingest.
+INGEST_BATCH = 100
+# Imports picture first so the GloVe load is left out, then times `import app`: opening the table and the segments,
+# loading the tombstones, content and vector indexes, and replaying the WAL.
+STARTUP_SCRIPT = """
+import time
+import picture
+start = time.perf_counter()
+import app
+print(time.perf_counter() - start)
+"""
+
+# Descriptions and queries are drawn from the most frequent GloVe words, so searches hit real postings.
+VOCABULARY = [w for w in MODEL.index_to_key[100:5100] if w.isascii() and w.isalpha()]
+
+
+def synthetic_image(rng: np.random.Generator, width: int, height: int) -> bytes:
+    # Smooth gradients plus noise, so JPEG sizes are closer to photos than flat colours are.
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    colour = rng.random(6, dtype=np.float32)
+    pixels = np.stack([colour[i] * x + colour[i + 3] * y for i in range(3)], axis=2) * 127
+    pixels += rng.integers(0, 64, size=pixels.shape)
+    out = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+def synthetic_description(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def percentiles(times: list[float]) -> dict:
+    times = sorted(times)
+    p99 = times[min(int(len(times) * 0.99), len(times) - 1)]
+    return dict(p50_ms=times[len(times) // 2] * 1000, p99_ms=p99 * 1000, count=len(times))
+
+
+def throughput(client, url: str, query_strings: list[dict]) -> dict:
+    start = time.perf_counter()
+    for query_string in query_strings:
+        assert client.get(url, query_string=query_string).status_code == 200
+    elapsed = time.perf_counter() - start
+    return dict(requests_per_second=len(query_strings) / elapsed, requests=len(query_strings))
+
+
+def ingest(client, count: int, first: int, args, np_rng, rng) -> tuple[dict, list[int]]:
+    # Only the uploads are timed, each batch of the corpus is generated before its clock starts.
+    elapsed = 0.0
+    ids = []
+    for batch_start in range(first, first + count, INGEST_BATCH):
+        batch = [(synthetic_image(np_rng, args.width, args.height), f"synthetic{i}.jpg",
+                  synthetic_description(rng, args.words))
+                 for i in range(batch_start, min(batch_start + INGEST_BATCH, first + count))]
+        start = time.perf_counter()
+        for contents, filename, description in batch:
+            response = client.post(
+                "/post-picture-simple",
+                data={"file": (io.BytesIO(contents), filename), "description": description},
+                content_type="multipart/form-data",
+            )
+            assert response.status_code == 200
+            ids.append(int(response.data))
+        elapsed += time.perf_counter() - start
+    return dict(images=count, seconds=elapsed, images_per_second=count / elapsed), ids
+
+
+def startup_seconds() -> float:
+    # A fresh process opening a copy of the corpus as it is now on disk. Its init_search flushes the table, removes
+    # orphan segments and rewrites the caches, so it must not share testfile/ with the handles open in this process.
+    # The code, native libraries and embeddings are linked, paths are relative to the working directory.
+    with tempfile.TemporaryDirectory() as root:
+        for name in os.listdir("."):
+            if name != "testfile":
+                os.symlink(os.path.abspath(name), os.path.join(root, name))
+        shutil.copytree("testfile", os.path.join(root, "testfile"))
+        out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=root, check=True, capture_output=True,
+                             text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def timed_get(client, url: str) -> float:
+    start = time.perf_counter()
+    assert client.get(url).status_code == 200
+    return time.perf_counter() - start
+
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    np_rng = np.random.default_rng(args.seed)
+    results = dict(
+        config=vars(args),
+        scales=[],
+    )
+
+    app.reset()
+    ids = []
+    with app.app.test_client() as client:
+        for scale in args.scales:
+            print("Scale", scale)
+            ingested, new_ids = ingest(client, scale - len(ids), len(ids), args, np_rng, rng)
+            ids += new_ids
+            flush_seconds = timed_get(client, "/flush-search")
+            compact_seconds = timed_get(client, "/compact")
+            # After the compaction, so the copy has a single segment and an empty WAL.
+            startup = startup_seconds()
+
+            search_times = []
+            for _ in range(args.searches):
+                query = synthetic_description(rng, rng.randint(1, 2))
+                start = time.perf_counter()
+                response = client.get("/search-results", query_string={"query": query})
+                search_times.append(time.perf_counter() - start)
+                assert response.status_code == 200
+
+            sample = [dict(id=rng.choice(ids)) for _ in range(args.requests)]
+            results["scales"].append(dict(
+                images=len(ids),
+                startup_seconds=startup,
+                ingest=ingested,
+                flush_seconds=flush_seconds,
+                compact_seconds=compact_seconds,
+                search=percentiles(search_times),
+                all=throughput(client, "/all", [{}] * args.requests),
+                img_data=throughput(client, "/img_data", sample),
+                img_data_thumb=throughput(client, "/img_data", [dict(q, size="thumb") for q in sample]),
+            ))
+
+    # ru_maxrss is in kilobytes on Linux
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # Where the time went over the whole run
+    results["stages"] = {stage: dict(calls=sum(counts), seconds=total)
+                         for stage, (counts, total) in metrics.STAGE_SECONDS.values.items()}
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    # Ratio of new to old for the headline numbers, per scale that both runs have.
+    old_scales = {s["images"]: s for s in baseline["scales"]}
+    print("peak rss", f'{results["peak_rss_mb"] / baseline["peak_rss_mb"]:.2f}x')
+    for new in results["scales"]:
+        old = old_scales.get(new["images"])
+        if old is None:
+            continue
+        print(f'{new["images"]} images:',
+              f'startup {new["startup_seconds"] / old["startup_seconds"]:.2f}x,',
+              f'ingest {new["ingest"]["images_per_second"] / old["ingest"]["images_per_second"]:.2f}x,',
+              f'flush {new["flush_seconds"] / old["flush_seconds"]:.2f}x,',
+              f'search p50 {new["search"]["p50_ms"] / old["search"]["p50_ms"]:.2f}x,',
+              f'search p99 {new["search"]["p99_ms"] / old["search"]["p99_ms"]:.2f}x,',
+              f'img_data {new["img_data"]["requests_per_second"] / old["img_data"]["requests_per_second"]:.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark with synthetic images, driven through the Flask test client. "
+                    "Wipes the data in testfile/.")
+    parser.add_argument("--wipe", action="store_true", help="required, confirms that testfile/ may be wiped")
+    parser.add_argument("--scales", type=lambda s: [int(x) for x in s.split(",")], default=[1000, 5000],
+                        help="corpus sizes to measure at, comma separated and increasing")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--words", type=int, default=90, help="words per description, about tags + synonyms")
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=200, help="requests per throughput measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    args = parser.parse_args()
+    if not args.wipe:
+        parser.error("the benchmark resets the repository in testfile/, pass --wipe to confirm")
+
+    results = run(args)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Saved", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from search_lib import ParallelIndexer
+
+# The process backend's workers import this module again as __mp_main__. They only run search_lib code, and must not
+# open the DB handles, load the embeddings or start the app's threads.
+if __name__ != "__mp_main__":
+    import app  # noqa: F401, opens the DB handles through init_search without starting the server
+    import DB
+    from api import compact_storage, flush_search, live_documents
+    from picture import generate_thumbnail, tag_image, index_synonyms_batch, find_duplicate, embed_tags, index_text
+    from table_manager import ImageDocument
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".tif", ".tiff"}
+
+
+def list_images(path: str, manifest: bool) -> list[str]:
+    if manifest:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    paths = []
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def load_checkpoint(path: str) -> set[str]:
+    try:
+        with open(path) as f:
+            return set(json.load(f)["done"])
+    except FileNotFoundError:
+        return set()
+
+
+def save_checkpoint(path: str, done: set[str]):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(dict(done=sorted(done)), f)
+    os.replace(temp_path, path)
+
+
+def read_and_tag(path: str):
+    try:
+        with open(path, "rb") as f:
+            contents = f.read()
+        original = find_duplicate(contents)
+        if original is not None:
+            return None, original
+        return contents, tag_image(generate_thumbnail(contents))
+    except Exception as e:
+        print("Skipping", path, e)
+        return None
+
+
+def tagged_images(paths: list[str], pool: ThreadPoolExecutor, window: int):
+    # Keeps `window` images in flight, so reading, thumbnailing and tagging overlap with expansion and storing.
+    futures = []
+    for path in paths:
+        futures.append((path, pool.submit(read_and_tag, path)))
+        if len(futures) >= window:
+            path, future = futures.pop(0)
+            yield path, future.result()
+    for path, future in futures:
+        yield path, future.result()
+
+
+def import_images(paths: list[str], checkpoint_path: str, batch_size: int, checkpoint_every: int, workers: int,
+                  tag_workers: int, backend: str):
+    done = load_checkpoint(checkpoint_path)
+    todo = [p for p in paths if p not in done]
+    print("Importing", len(todo), "images,", len(paths) - len(todo), "already done")
+
+    with ThreadPoolExecutor(tag_workers) as pool:
+        for start in range(0, len(todo), checkpoint_every):
+            chunk = todo[start: start + checkpoint_every]
+            # Every chunk becomes one index segment and one table flush, then it's recorded in the checkpoint.
+            first_id = DB.SEARCH.reserve_ids(len(chunk))
+            suffix = f"seg-{DB.SEARCH.next_generation()}"
+            with ParallelIndexer(workers, suffix, backend, expected_docs=len(chunk)) as indexer:
+                batch = []
+                for i, (path, result) in enumerate(tagged_images(chunk, pool, batch_size * 4)):
+                    if result is not None:
+                        batch.append((first_id + i, path, *result))
+                    if len(batch) >= batch_size:
+                        store_batch(batch, indexer)
+                        batch = []
+                store_batch(batch, indexer)
+                indexer.end()
+
+            # The rows aren't logged, so they're flushed before the segment that points at them goes live.
+            DB.tbm.flush()
+            DB.CONTENT.flush()
+            DB.VECTORS.flush()
+            DB.SEARCH.add_segment(suffix, indexer.count)
+            done.update(chunk)
+            save_checkpoint(checkpoint_path, done)
+            print("Imported", start + len(chunk), "/", len(todo))
+
+    flush_search()
+
+
+def store_batch(batch: list, indexer: ParallelIndexer):
+    if not batch:
+        return
+    # Duplicates of stored images come back from read_and_tag with the original's document instead of tags.
+    tagged = [item for item in batch if not isinstance(item[3], ImageDocument)]
+    expanded = iter(index_synonyms_batch([tags for _, _, _, tags in tagged]))
+    rows = []
+    hashes = []
+    copies = []
+    for id, path, contents, tags in batch:
+        filename = os.path.basename(path)
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if isinstance(tags, ImageDocument):
+            # Indexed and embedded with the original's tags, without touching Azure or the vocabulary.
+            db_data = dict(tags.metadata, filename=filename, mimetype=mimetype,
+                           blob=tags.metadata.get("blob", tags.id))
+            indexer.append_file(index_text(db_data), id)
+            rows.append((id, filename, json.dumps(db_data), b""))
+            copies.append((db_data["blob"], id))
+            tags = db_data.get("tags", [])
+        else:
+            description = " ".join(next(expanded) + tags)
+            sha256 = hashlib.sha256(contents).hexdigest()
+            db_data = dict(synonyms_desc=description, filename=filename, mimetype=mimetype, sha256=sha256, tags=tags)
+            indexer.append_file(description, id)
+            rows.append((id, filename, json.dumps(db_data), contents))
+            hashes.append((sha256, id))
+        vector = embed_tags(tags)
+        if vector is not None:
+            DB.VECTORS.append(id, vector)
+    # Not logged: the checkpoint only advances after the table flush.
+    DB.tbm.store_many(rows, log=False)
+    for sha256, id in hashes:
+        DB.CONTENT.add(sha256, id)
+    for blob, id in copies:
+        DB.CONTENT.add_copy(blob, id)
+
+
+def build_vectors(nlist: int):
+    # Embeds every stored image that has its tags recorded, then clusters the vectors for IVF search.
+    flush_search()
+    for doc in DB.tbm.select(0b0101):
+        if doc.metadata and "tags" in doc.metadata:
+            vector = embed_tags(doc.metadata["tags"])
+            if vector is not None:
+                DB.VECTORS.append(doc.id, vector)
+    DB.VECTORS.build_ivf(nlist or None)
+    DB.VECTORS.flush()
+    print("Vector index has", len(DB.VECTORS), "images")
+
+
+def reindex(workers: int, backend: str):
+    # Start from a flushed table and an empty working index, so every document is indexed exactly once.
+    flush_search()
+    count = DB.SEARCH.rebuild(live_documents(), workers, backend, DB.tbm.catalog.row_count)
+    print("Reindexed", count, "documents into", DB.SEARCH.name())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import images, or rebuild the search index from the table.")
+    parser.add_argument("path", nargs="?", help="directory of images, or a manifest file with --manifest")
+    parser.add_argument("--manifest", action="store_true", help="path is a file with one image path per line")
+    parser.add_argument("--reindex", action="store_true", help="rebuild the search index from stored descriptions")
+    parser.add_argument("--compact", action="store_true",
+                        help="drop deleted images from the table, then reindex")
+    parser.add_argument("--vectors", action="store_true",
+                        help="embed every stored image and build the IVF clusters for mode=vector search")
+    parser.add_argument("--nlist", type=int, default=0, help="IVF clusters, sqrt(images) by default")
+    parser.add_argument("--checkpoint", default="testfile/import-checkpoint.json")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--checkpoint-every", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--tag-workers", type=int, default=16)
+    parser.add_argument("--backend", choices=["thread", "process"], default="process")
+    args = parser.parse_args()
+
+    if args.vectors:
+        build_vectors(args.nlist)
+    elif args.compact:
+        compact_storage(args.workers, args.backend)
+    elif args.reindex:
+        reindex(args.workers, args.backend)
+    elif args.path:
+        paths = list_images(args.path, args.manifest)
+        import_images(paths, args.checkpoint, args.batch_size, args.checkpoint_every, args.workers,
+                      args.tag_workers, args.backend)
+    else:
+        parser.error("a path is required unless --reindex, --compact or --vectors is given")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import dataclasses
+import json
+import os
+import threading
+from typing import Optional
+
+
+@dataclasses.dataclass
+class Catalog:
+    """
+    Small persisted summary of the images table and the search index, so startup doesn't have to scan the table.
+    max_id is the largest id ever stored, so ids are never reused after deletes.
+    """
+    path: str
+    max_id: int = 0
+    row_count: int = 0
+    generation: int = 0
+    # Search index segments, oldest first: [{"name": suffix, "docs": document count}]
+    segments: list = dataclasses.field(default_factory=list)
+    # Every logged index append with an id at or below this is in a persisted segment, so WAL replay skips it.
+    indexed_through: int = 0
+    # Both the table and the search index persist the catalog, from different threads.
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, repr=False, compare=False)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Catalog"]:
+        try:
+            with open(path) as f:
+                return cls(path, **json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def record_store(self, id: int):
+        # Ids are handed out in increasing order, so anything at or below max_id overwrites an existing row.
+        if id > self.max_id:
+            self.max_id = id
+            self.row_count += 1
+
+    def next_generation(self) -> int:
+        self.generation += 1
+        return self.generation
+
+    def persist(self):
+        with self.lock:
+            data = dict(max_id=self.max_id, row_count=self.row_count, generation=self.generation,
+                        segments=self.segments, indexed_through=self.indexed_through)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
@@ -0,0 +1,101 @@
+import os
+import threading
+from typing import Optional
+
+
+class ContentIndex:
+    """
+    sha256 of image bytes -> id of the row that holds them, so re-uploads of the same photo skip tagging and the blob
+    store. Also tracks which live duplicate rows point at each blob, so a delete only keeps the bytes when a copy still
+    needs them. Kept in an append-only log next to the table, fsynced on flush; later lines win.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids: dict[str, int] = {}
+        # blob id -> ids of the live copies pointing at it, and the reverse
+        self.copies: dict[int, set[int]] = {}
+        self.blobs: dict[int, int] = {}
+        self.lock = threading.Lock()
+        self.file = None
+
+    @classmethod
+    def load(cls, path: str) -> Optional["ContentIndex"]:
+        if not os.path.exists(path):
+            return None
+        index = cls(path)
+        with open(path) as f:
+            for line in f:
+                # A torn last line from a crash is skipped, the WAL replay adds it back.
+                if not line.endswith("\n"):
+                    break
+                parts = line.split()
+                if len(parts) == 2 and len(parts[0]) == 64:
+                    index.ids[parts[0]] = int(parts[1])
+                elif len(parts) == 3 and parts[0] == "+":
+                    index.add_copy_locked(int(parts[1]), int(parts[2]))
+                elif len(parts) == 3 and parts[0] == "-":
+                    index.remove_copy_locked(int(parts[2]))
+        return index
+
+    def get(self, sha256: str) -> Optional[int]:
+        return self.ids.get(sha256)
+
+    def has_copies(self, blob: int) -> bool:
+        return bool(self.copies.get(blob))
+
+    def add(self, sha256: str, id: int):
+        with self.lock:
+            if self.ids.get(sha256) == id:
+                return
+            self.ids[sha256] = id
+            self.write(f"{sha256} {id}\n")
+
+    def add_copy(self, blob: int, id: int):
+        with self.lock:
+            if self.blobs.get(id) == blob:
+                return
+            self.add_copy_locked(blob, id)
+            self.write(f"+ {blob} {id}\n")
+
+    def add_copy_locked(self, blob: int, id: int):
+        self.blobs[id] = blob
+        self.copies.setdefault(blob, set()).add(id)
+
+    def remove_copy(self, id: int):
+        # No-op for ids that aren't copies, so every delete can call it.
+        with self.lock:
+            blob = self.remove_copy_locked(id)
+            if blob is not None:
+                self.write(f"- {blob} {id}\n")
+
+    def remove_copy_locked(self, id: int) -> Optional[int]:
+        blob = self.blobs.pop(id, None)
+        if blob is not None:
+            self.copies[blob].discard(id)
+            if not self.copies[blob]:
+                del self.copies[blob]
+        return blob
+
+    def write(self, line: str):
+        if self.file is None:
+            self.file = open(self.path, "a")
+        self.file.write(line)
+
+    def flush(self):
+        with self.lock:
+            if self.file is None:
+                open(self.path, "a").close()
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def clear(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.ids = {}
+            self.copies = {}
+            self.blobs = {}
+            open(self.path, "w").close()
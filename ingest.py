@@ -0,0 +1,156 @@
+import dataclasses
+import os
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import DB
+from picture import generate_thumbnail, tag_image, index_synonyms_batch, post_picture, find_duplicate, post_duplicate
+
+
+@dataclasses.dataclass
+class IngestFile:
+    filename: str
+    mimetype: str
+    contents: Optional[bytes]
+    # queued -> thumbnail -> tagging -> expanding -> storing -> done, or failed from any stage
+    status: str = "queued"
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+    def to_json(self) -> dict:
+        return dict(filename=self.filename, status=self.status, id=self.id, error=self.error)
+
+
+@dataclasses.dataclass
+class IngestJob:
+    id: str
+    files: list[IngestFile]
+    flush: bool
+    finished: int = 0
+
+    def done(self) -> bool:
+        return self.finished == len(self.files)
+
+    def to_json(self) -> dict:
+        return dict(job=self.id, done=self.done(), files=[f.to_json() for f in self.files])
+
+
+class IngestPipeline:
+    """
+    Runs uploads through thumbnail -> tagging -> expansion -> store. Each stage has its own workers, so the network
+    bound Azure calls overlap with thumbnail decoding and expansion. Expansion drains everything tagged so far and
+    expands it in one vocabulary pass. The store stage has a single worker, so writes stay serialized.
+    """
+
+    def __init__(self, cpu_workers: Optional[int] = None, tag_workers=8, max_jobs=1000, expand_batch=256,
+                 on_job_done: Optional[Callable[[IngestJob], None]] = None):
+        self.cpu_pool = ThreadPoolExecutor(cpu_workers or os.cpu_count(), thread_name_prefix="ingest-cpu")
+        self.tag_pool = ThreadPoolExecutor(tag_workers, thread_name_prefix="ingest-tag")
+        self.store_pool = ThreadPoolExecutor(1, thread_name_prefix="ingest-store")
+        self.expand_batch = expand_batch
+        self.expand_queue = queue.Queue()
+        threading.Thread(target=self.expand_loop, name="ingest-expand", daemon=True).start()
+        self.max_jobs = max_jobs
+        self.on_job_done = on_job_done
+        self.jobs: OrderedDict[str, IngestJob] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, files: list[tuple[bytes, str, str]], flush=False) -> IngestJob:
+        job = IngestJob(uuid.uuid4().hex, [IngestFile(filename, mimetype, contents)
+                                           for contents, filename, mimetype in files], flush)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+
+        for file in job.files:
+            self.cpu_pool.submit(self.stage, job, file, self.run_thumbnail)
+        if not job.files:
+            self.finish_job(job)
+        return job
+
+    def status(self, job_id: str) -> Optional[IngestJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def stage(self, job: IngestJob, file: IngestFile, fn, *args):
+        try:
+            fn(job, file, *args)
+        except Exception as e:
+            self.fail(job, file, e)
+
+    def fail(self, job: IngestJob, file: IngestFile, e: Exception):
+        print("Ingest failed", file.filename, file.status, e)
+        file.status = "failed"
+        file.error = str(e)
+        file.contents = None
+        self.finish_file(job)
+
+    def run_thumbnail(self, job: IngestJob, file: IngestFile):
+        original = find_duplicate(file.contents)
+        if original is not None:
+            # Same bytes as a stored image: no thumbnail, tagging or expansion, only a metadata row.
+            file.status = "storing"
+            self.store_pool.submit(self.stage, job, file, self.run_store_duplicate, original)
+            return
+        file.status = "thumbnail"
+        thumbnail = generate_thumbnail(file.contents)
+        file.status = "tagging"
+        self.tag_pool.submit(self.stage, job, file, self.run_tagging, thumbnail)
+
+    def run_tagging(self, job: IngestJob, file: IngestFile, thumbnail):
+        tags = tag_image(thumbnail)
+        file.status = "expanding"
+        self.expand_queue.put((job, file, tags))
+
+    def expand_loop(self):
+        while True:
+            batch = [self.expand_queue.get()]
+            while len(batch) < self.expand_batch:
+                try:
+                    batch.append(self.expand_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                expanded = index_synonyms_batch([tags for _, _, tags in batch])
+            except Exception as e:
+                for job, file, _ in batch:
+                    self.fail(job, file, e)
+                continue
+
+            for (job, file, tags), synonyms in zip(batch, expanded):
+                file.status = "storing"
+                self.store_pool.submit(self.stage, job, file, self.run_store, " ".join(synonyms + tags), tags)
+
+    def run_store(self, job: IngestJob, file: IngestFile, document_str: str, tags: list[str]):
+        id = post_picture(file.contents, document_str, file.filename, file.mimetype, tags)
+        DB.WAL.commit()
+        file.id = int(id)
+        file.status = "done"
+        file.contents = None
+        self.finish_file(job)
+
+    def run_store_duplicate(self, job: IngestJob, file: IngestFile, original):
+        id = post_duplicate(original, file.filename, file.mimetype)
+        DB.WAL.commit()
+        file.id = int(id)
+        file.status = "done"
+        file.contents = None
+        self.finish_file(job)
+
+    def finish_file(self, job: IngestJob):
+        with self.lock:
+            job.finished += 1
+            done = job.done()
+        if done:
+            self.finish_job(job)
+
+    def finish_job(self, job: IngestJob):
+        print("Ingest job done", job.id)
+        if self.on_job_done:
+            self.on_job_done(job)
@@ -4,6 +4,8 @@ import flask
 from flask import request
 
 import DB
+from picture import embed_tags
+from table_manager import METADATA_COLUMNS
 
 public = flask.Blueprint("public", __name__)
 
@@ -17,11 +19,11 @@ def upload():
 def picture_by_id():
     id: int = int(request.args["id"])
     url = flask.url_for("api.img_data", id=id)
-    db_data = DB.tbm.get_name(id)
+    doc = DB.tbm.get(id, METADATA_COLUMNS)
 
-    if db_data is None:
+    if doc is None:
         raise RuntimeError("ID not found!")
-    db_data = json.loads(db_data)
+    db_data = json.loads(doc.description)
     title = db_data["filename"]
     return flask.render_template("picture.html", title=title, url=url)
 
@@ -46,29 +48,45 @@ def search():
 @public.route("/search-results")
 def search_picture():
     search_query: str = request.args["query"]
-    a = DB.SEARCH.search_terms(search_query)
+    offset = int(request.args.get("offset", 0))
+    if request.args.get("mode", "text") == "vector":
+        return search_picture_vector(search_query, offset)
+    a = DB.SEARCH.search_terms(search_query, offset=offset, min_score=4)
     print(a.printable())
+    hits = list(a.scores.keys())
+    files = DB.tbm.get_many(hits, METADATA_COLUMNS)
     imgurls = []
-    for id in a.scores.keys():
-        if a.scores[id] < 4:
-            continue
-        file = DB.tbm.get(id, 0b0111)
-        if not json.loads(file.description):
+    for id in hits:
+        file = files.get(id)
+        if file is None or not file.metadata:
             continue
+        synonyms_desc = file.metadata["synonyms_desc"]
         matched_words = []
         for match, mlen in a.matches[id]:
-                matched_words.append(
-                    json.loads(file.description)["synonyms_desc"][match: match + mlen]
-                )
+            matched_words.append(synonyms_desc[match: match + mlen])
 
         caption_string = f"<b>{file.filename}</b><br>Matched {','.join(matched_words)}"
         imgurls.append((id, caption_string))
     return flask.render_template("search-results.html", imgurls=imgurls)
 
 
+def search_picture_vector(search_query: str, offset: int):
+    query = embed_tags(search_query.lower().split())
+    hits = DB.VECTORS.search(query, offset=offset) if query is not None else []
+    files = DB.tbm.get_many([id for id, _ in hits], METADATA_COLUMNS)
+    imgurls = []
+    for id, score in hits:
+        file = files.get(id)
+        if file is None or not file.metadata:
+            continue
+        caption_string = f"<b>{file.filename}</b><br>Similarity {score:.2f}"
+        imgurls.append((id, caption_string))
+    return flask.render_template("search-results.html", imgurls=imgurls)
+
+
 @public.route("/img-view")
 def image_view():
     id = int(request.args["id"])
-    data = DB.tbm.get(id, 0b0111)
+    data = DB.tbm.get(id, METADATA_COLUMNS)
     return flask.render_template("picture.html", id=id, filename=data.filename,
                                  description=data.description)
@@ -0,0 +1,145 @@
+import contextlib
+import json
+import threading
+import time
+from typing import Optional
+
+# Upper bounds in seconds, from sub-millisecond FFI calls up to Azure round trips and compactions.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """
+    Prometheus histogram with one label. Buckets are cumulative only when rendered.
+    """
+
+    def __init__(self, name: str, help: str, label: str, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # label value -> [count per bucket (+Inf last), sum]
+        self.values: dict[str, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value: str, seconds: float):
+        with self.lock:
+            value = self.values.get(label_value)
+            if value is None:
+                value = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            i = 0
+            while i < len(self.buckets) and seconds > self.buckets[i]:
+                i += 1
+            value[0][i] += 1
+            value[1] += seconds
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = {k: (list(v[0]), v[1]) for k, v in self.values.items()}
+        for label_value, (counts, total) in sorted(values.items()):
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, int] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = dict(self.values)
+        for label_values, count in sorted(values.items()):
+            labels = ",".join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            lines.append(f"{self.name}{{{labels}}} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("imgrepo_stage_seconds", "Time spent in FFI calls, decoding, thumbnailing and tagging",
+                          "stage")
+REQUEST_SECONDS = Histogram("imgrepo_request_seconds", "Request latency by endpoint", "endpoint")
+REQUESTS = Counter("imgrepo_requests_total", "Requests by endpoint and status", ("endpoint", "status"))
+
+# Per-request stage totals for the slow request log, only set on request threads.
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(stage, elapsed)
+        stages = getattr(_local, "stages", None)
+        if stages is not None:
+            total = stages.setdefault(stage, [0.0, 0])
+            total[0] += elapsed
+            total[1] += 1
+
+
+class SlowRequestLog:
+    """
+    JSON lines of requests slower than threshold_seconds, with the time and call count of every timed stage.
+    """
+
+    def __init__(self, path: str, threshold_seconds: float):
+        self.path = path
+        self.threshold_seconds = threshold_seconds
+        self.lock = threading.Lock()
+
+    def start_request(self):
+        _local.stages = {}
+        _local.start = time.perf_counter()
+
+    def finish_request(self, endpoint: Optional[str], status: int, url: str):
+        start = getattr(_local, "start", None)
+        stages = getattr(_local, "stages", None) or {}
+        _local.stages = _local.start = None
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        endpoint = endpoint or "unknown"
+        REQUEST_SECONDS.observe(endpoint, elapsed)
+        REQUESTS.inc(endpoint, status)
+
+        if elapsed < self.threshold_seconds:
+            return
+        entry = dict(
+            time=time.time(), endpoint=endpoint, url=url, status=status, ms=round(elapsed * 1000, 2),
+            stages={stage: dict(ms=round(total * 1000, 2), calls=calls) for stage, (total, calls) in stages.items()},
+        )
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+def gauge(name: str, help: str, value) -> list[str]:
+    return [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+
+
+def counter(name: str, help: str, value) -> list[str]:
+    # For totals kept elsewhere, like the cache hit counts. name should end in _total.
+    return [f"# HELP {name} {help}", f"# TYPE {name} counter", f"{name} {value}"]
+
+
+def render(extra: list[str] = ()) -> str:
+    # extra: lines from gauge() and counter()
+    lines = STAGE_SECONDS.render() + REQUEST_SECONDS.render() + REQUESTS.render() + list(extra)
+    return "\n".join(lines) + "\n"
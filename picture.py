@@ -1,13 +1,22 @@
+import atexit
+import hashlib
 import io
 import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
 
-from PIL import Image
+import numpy as np
+from PIL import Image, features
 from azure.cognitiveservices.vision.computervision import ComputerVisionClient
 from gensim.models import KeyedVectors
 from msrest.authentication import CognitiveServicesCredentials
 
 import DB
 from creds import ENDPOINT, KEY1 as SUBSCRIPTION_KEY
+from metrics import timed
+from table_manager import ImageDocument, METADATA_COLUMNS
 
 computervision_client = ComputerVisionClient(
     ENDPOINT, CognitiveServicesCredentials(SUBSCRIPTION_KEY)
@@ -16,17 +25,264 @@ computervision_client = ComputerVisionClient(
 # MODEL = KeyedVectors.load_word2vec_format("glove.6B.100d.txt", no_header=True)
 # MODEL.save("glove.bin")
 MODEL = KeyedVectors.load("glove.bin")
+# Unit length rows of the embedding matrix, the same vectors MODEL.most_similar scores against.
+NORMED = MODEL.get_normed_vectors()
 
+# Optional precomputed nearest neighbours per vocabulary word, see build_neighbour_table.
+NEIGHBOUR_TABLE_PATH = "glove-neighbours.npy"
+NEIGHBOUR_TABLE = np.load(NEIGHBOUR_TABLE_PATH, mmap_mode="r") if os.path.exists(NEIGHBOUR_TABLE_PATH) else None
+EXPANSION_TOPN = 80
+# Neighbours kept per tag, the candidates an image's expansion is picked from. Same depth as build_neighbour_table.
+TAG_NEIGHBOURS = EXPANSION_TOPN * 2
+# Set by init_search from app.config["QUERY_EXPANSION"]. When on, documents are indexed with their raw tags only and
+# searches expand the query instead (expand_query).
+QUERY_EXPANSION = False
+# Images expanded per matrix product, bounds the (chunk, vocab) similarity matrix.
+EXPANSION_CHUNK = 64
 
-def generate_most_similar(img) -> [str]:
-    tags = [t.name for t in computervision_client.tag_image_in_stream(img).tags]
-    tags_knn = list(filter(lambda k: MODEL.has_index_for(k), tags))
-    synonyms = MODEL.most_similar(positive=tags_knn, topn=80)
-    return [x[0] for x in synonyms] + tags
+
+def model_fingerprint() -> str:
+    # Cheap identity of the loaded embeddings: shape, a strided sample of the vectors and the head of the vocabulary.
+    h = hashlib.sha1(str(MODEL.vectors.shape).encode("ascii"))
+    h.update(np.ascontiguousarray(MODEL.vectors[::1000]).tobytes())
+    h.update(" ".join(MODEL.index_to_key[:1000]).encode("utf8"))
+    return h.hexdigest()
+
+
+class NeighbourCache:
+    """
+    LRU of expansion results keyed by the set of known tags, and of the nearest neighbours of single tags, persisted as
+    JSON. Entries are only loaded back if they were computed with the same model, so replacing glove.bin invalidates
+    the cache.
+    """
+
+    def __init__(self, path, fingerprint: str, max_entries=10000):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, list[str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Flushes run on request threads and the ingest store thread, saves share one temp file.
+        self.save_lock = threading.Lock()
+
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            if saved["fingerprint"] == fingerprint:
+                self.entries.update(saved["entries"])
+            else:
+                print("Neighbour cache is from a different model, discarding")
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+            # Only a cache, start empty and overwrite it on the next save.
+            print("Neighbour cache is unreadable, discarding", e)
+            self.entries.clear()
+
+    @classmethod
+    def key(cls, tag_indices: [int], topn: int) -> str:
+        return f"{topn}:" + " ".join(MODEL.index_to_key[i] for i in sorted(set(tag_indices)))
+
+    @classmethod
+    def tag_key(cls, tag_index: int, k: int) -> str:
+        return f"tag{k}:{MODEL.index_to_key[tag_index]}"
+
+    def get(self, key: str):
+        with self.lock:
+            words = self.entries.get(key)
+            if words is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return words
+
+    def put(self, key: str, words: [str]):
+        with self.lock:
+            self.entries[key] = words
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, entries=len(self.entries))
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                data = dict(fingerprint=self.fingerprint, entries=list(self.entries.items()))
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+
+
+NEIGHBOURS = NeighbourCache("testfile/neighbour-cache.json", model_fingerprint())
+atexit.register(NEIGHBOURS.save)
+
+# Bounding boxes for the resized variants served by /img_data. "full" is the original blob.
+RENDITION_SIZES = {"thumb": (320, 320), "medium": (1024, 1024)}
+WEBP_SUPPORTED = features.check("webp")
+
+
+def tag_image(img) -> [str]:
+    with timed("azure_tag"):
+        return [t.name for t in computervision_client.tag_image_in_stream(img).tags]
+
+
+def index_synonyms_batch(tag_lists: [[str]]) -> [[str]]:
+    # Synonyms indexed with each image, none when the query is expanded instead.
+    if QUERY_EXPANSION:
+        return [[] for _ in tag_lists]
+    return expand_tags_batch(tag_lists)
+
+
+def index_text(db_data: dict) -> str:
+    # Text indexed for a stored image when the index is rebuilt
+    if QUERY_EXPANSION and "tags" in db_data:
+        return " ".join(db_data["tags"])
+    return db_data["synonyms_desc"]
+
+
+def expand_query(terms: [str], topn: int) -> [(str, float)]:
+    """
+    Neighbours of the query words, each weighted by its cosine similarity to the query's mean vector. Served from the
+    neighbour cache like index-time expansion, so only new queries touch the vocabulary.
+    """
+    words = [t.lower() for t in terms]
+    keys = [MODEL.get_index(w) for w in words if MODEL.has_index_for(w)]
+    if not keys or topn <= 0:
+        return []
+    neighbours = expand_tags_batch([words], topn)[0]
+    if not neighbours:
+        return []
+    sims = NORMED[[MODEL.get_index(w) for w in neighbours]] @ query_vectors([keys])[0]
+    return list(zip(neighbours, sims.tolist()))
+
+
+def expand_tags_batch(tag_lists: [[str]], topn=EXPANSION_TOPN, exact=False) -> [[str]]:
+    """
+    Neighbours of the mean of the normalized tag vectors of each image, like MODEL.most_similar(positive=tags), for
+    many images at once. Candidates are the nearest neighbours of each tag (from NEIGHBOUR_TABLE or the neighbour
+    cache), rescored against the mean vector, so a new tag set only costs a vocabulary scan for tags never seen before.
+    exact=True scores the whole vocabulary instead and bypasses the cache.
+    """
+    index_lists = [[MODEL.get_index(t) for t in tags if MODEL.has_index_for(t)] for tags in tag_lists]
+    results = [[] for _ in tag_lists]
+    todo = []
+    for i, keys in enumerate(index_lists):
+        if not keys:
+            continue
+        cached = None if exact else NEIGHBOURS.get(NeighbourCache.key(keys, topn))
+        if cached is not None:
+            results[i] = cached
+        else:
+            todo.append(i)
+
+    if todo:
+        with timed("most_similar"):
+            expand_uncached(todo, index_lists, results, topn, exact)
+
+    if not exact:
+        for i in todo:
+            NEIGHBOURS.put(NeighbourCache.key(index_lists[i], topn), results[i])
+    return results
+
+
+def expand_uncached(todo: [int], index_lists: [[int]], results: [[str]], topn: int, exact=False):
+    for start in range(0, len(todo), EXPANSION_CHUNK):
+        rows = todo[start: start + EXPANSION_CHUNK]
+        queries = query_vectors([index_lists[i] for i in rows])
+
+        if exact:
+            sims = queries @ NORMED.T
+            for row, row_sims in zip(rows, sims):
+                results[row] = rank_neighbours(None, row_sims, index_lists[row], topn)
+            continue
+
+        if NEIGHBOUR_TABLE is not None and all(max(index_lists[i]) < len(NEIGHBOUR_TABLE) for i in rows):
+            neighbours = {k: NEIGHBOUR_TABLE[k] for i in rows for k in index_lists[i]}
+        else:
+            neighbours = tag_neighbours(set(k for i in rows for k in index_lists[i]), max(TAG_NEIGHBOURS, 2 * topn))
+        # Candidates are the neighbours of each tag, rescored against the image's mean vector.
+        for row, query in zip(rows, queries):
+            candidates = np.unique(np.concatenate([neighbours[k] for k in index_lists[row]]))
+            results[row] = rank_neighbours(candidates, NORMED[candidates] @ query, index_lists[row], topn)
+
+
+def tag_neighbours(keys: set[int], k: int) -> dict[int, np.ndarray]:
+    # Nearest k words of each tag, from the neighbour cache or one vocabulary scan per chunk of new tags.
+    lists = {}
+    missing = []
+    for key in keys:
+        words = NEIGHBOURS.get(NeighbourCache.tag_key(key, k))
+        if words is None:
+            missing.append(key)
+        else:
+            lists[key] = np.array([MODEL.get_index(w) for w in words], dtype=np.int64)
+
+    for start in range(0, len(missing), EXPANSION_CHUNK):
+        chunk = missing[start: start + EXPANSION_CHUNK]
+        sims = NORMED[chunk] @ NORMED.T
+        for key, row_sims in zip(chunk, sims):
+            words = rank_neighbours(None, row_sims, [key], k)
+            NEIGHBOURS.put(NeighbourCache.tag_key(key, k), words)
+            lists[key] = np.array([MODEL.get_index(w) for w in words], dtype=np.int64)
+    return lists
+
+
+def query_vectors(index_lists: [[int]]) -> np.ndarray:
+    queries = np.stack([NORMED[keys].mean(axis=0) for keys in index_lists])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def embed_tags(tags: [str]) -> Optional[np.ndarray]:
+    # Mean of the normalized vectors of the known words, unit length. Used for images and queries alike.
+    keys = [MODEL.get_index(t) for t in tags if MODEL.has_index_for(t)]
+    if not keys:
+        return None
+    return query_vectors([keys])[0]
+
+
+def rank_neighbours(candidates, sims: np.ndarray, exclude: [int], topn: int) -> [str]:
+    if candidates is None:
+        sims[exclude] = -np.inf
+    else:
+        sims[np.isin(candidates, exclude)] = -np.inf
+
+    if len(sims) > topn:
+        top = np.argpartition(-sims, topn)[:topn]
+    else:
+        top = np.arange(len(sims))
+    top = top[np.argsort(-sims[top])]
+    top = top[np.isfinite(sims[top])]
+    if candidates is not None:
+        top = candidates[top]
+    return [MODEL.index_to_key[i] for i in top]
+
+
+def build_neighbour_table(path=NEIGHBOUR_TABLE_PATH, k=EXPANSION_TOPN * 2, restrict_vocab=None, chunk=256):
+    """
+    Exact top-k neighbours for the first `restrict_vocab` words (GloVe orders its vocabulary by frequency), searched
+    among those same words. Saved as an int32 .npy that is memory mapped on startup.
+    """
+    vocab = NORMED[:restrict_vocab or len(NORMED)]
+    table = np.lib.format.open_memmap(path, mode="w+", dtype=np.int32, shape=(len(vocab), k))
+    for start in range(0, len(vocab), chunk):
+        sims = vocab[start: start + chunk] @ vocab.T
+        sims[np.arange(len(sims)), np.arange(start, start + len(sims))] = -np.inf
+        top = np.argpartition(-sims, k, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+        table[start: start + len(sims)] = np.take_along_axis(top, order, axis=1)
+        print("Neighbour table", start + len(sims), "/", len(vocab))
+    table.flush()
+    return table
 
 
 def generate_thumbnail(img):
-    with Image.open(io.BytesIO(img)).convert("RGB") as im:
+    with timed("thumbnail"), Image.open(io.BytesIO(img)).convert("RGB") as im:
         im.thumbnail((512, 512))
         out = io.BytesIO()
         im.save(out, format="JPEG")
@@ -34,10 +290,56 @@ def generate_thumbnail(img):
         return out
 
 
-def post_picture(file, description, filename, mimetype):
-    id = DB.SEARCH.append_file(description)
-    print("Posting to ", id)
+def generate_rendition(img: bytes, size: str, fmt: str = "jpeg") -> bytes:
+    with timed("rendition"), Image.open(io.BytesIO(img)).convert("RGB") as im:
+        im.thumbnail(RENDITION_SIZES[size])
+        out = io.BytesIO()
+        im.save(out, format=fmt.upper(), quality=80)
+        return out.getvalue()
+
+
+def post_picture(file, description, filename, mimetype, tags: Optional[list[str]] = None):
+    sha256 = hashlib.sha256(file).hexdigest()
+    db_data = dict(synonyms_desc=description, filename=filename, mimetype=mimetype, sha256=sha256)
+    vector = None
+    if tags is not None:
+        # Kept so the vector index can be rebuilt from the table
+        db_data["tags"] = tags
+        vector = embed_tags(tags)
+    with DB.WRITER:
+        id = DB.SEARCH.append_file(description)
+        print("Posting to ", id)
+        DB.tbm.store(id, filename, json.dumps(db_data), file)
+        DB.CONTENT.add(sha256, id)
+        if vector is not None:
+            DB.VECTORS.append(id, vector)
+    return str(id)
+
+
+def find_duplicate(file: bytes) -> Optional[ImageDocument]:
+    # The live image with the same bytes, if any. Metadata only.
+    id = DB.CONTENT.get(hashlib.sha256(file).hexdigest())
+    if id is None:
+        return None
+    original = DB.tbm.get(id, METADATA_COLUMNS)
+    if original is None or original.metadata is None:
+        return None
+    return original
+
 
-    db_data = dict(synonyms_desc=description, filename=filename, mimetype=mimetype)
-    DB.tbm.store(id, filename, json.dumps(db_data), file)
+def post_duplicate(original: ImageDocument, filename, mimetype):
+    """
+    Stores a re-upload as a new row that points at the original's blob and reuses its tags. The copy is indexed and
+    embedded on its own, so it stays searchable under its own name after the original is deleted.
+    """
+    db_data = dict(original.metadata, filename=filename, mimetype=mimetype,
+                   blob=original.metadata.get("blob", original.id))
+    vector = embed_tags(db_data["tags"]) if "tags" in db_data else None
+    with DB.WRITER:
+        id = DB.SEARCH.append_file(index_text(db_data))
+        print("Posting duplicate of", original.id, "to", id)
+        DB.tbm.store(id, filename, json.dumps(db_data), b"")
+        DB.CONTENT.add_copy(db_data["blob"], id)
+        if vector is not None:
+            DB.VECTORS.append(id, vector)
     return str(id)
@@ -0,0 +1,119 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class RenditionCache:
+    """
+    Two level LRU cache for resized image renditions. The memory level holds the hottest renditions,
+    the disk level holds everything that has been generated so far. Both levels are bounded in bytes.
+    """
+
+    def __init__(self, path, max_memory_bytes=64 * 1024 * 1024, max_disk_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory: OrderedDict[str, bytes] = OrderedDict()
+        self.memory_bytes = 0
+        self.disk: OrderedDict[str, int] = OrderedDict()
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        # Rebuild the disk LRU order from modification times, which are touched on every read.
+        entries = []
+        for name in os.listdir(path):
+            st = os.stat(os.path.join(path, name))
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self.disk[name] = size
+            self.disk_bytes += size
+
+    @classmethod
+    def key(cls, id: int, size: str, fmt: str) -> str:
+        return f"{id}-{size}.{fmt}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return data
+            if key not in self.disk:
+                self.misses += 1
+                return None
+
+        # Disk hits are read without the lock, so concurrent thumbnail requests don't queue behind each other's reads.
+        file_path = os.path.join(self.path, key)
+        try:
+            with open(file_path, "rb") as f:
+                data = f.read()
+            os.utime(file_path)
+        except FileNotFoundError:
+            # Evicted or invalidated since the check.
+            with self.lock:
+                if key in self.disk and not os.path.exists(file_path):
+                    self.disk_bytes -= self.disk.pop(key)
+                self.misses += 1
+            return None
+
+        with self.lock:
+            # Not promoted if invalidate() ran during the read.
+            if key in self.disk:
+                self.disk.move_to_end(key)
+                self._put_memory(key, data)
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self.lock:
+            self.put_locked(key, data)
+
+    def put_locked(self, key: str, data: bytes):
+        self._put_memory(key, data)
+
+        if key in self.disk:
+            self.disk_bytes -= self.disk.pop(key)
+        temp_path = os.path.join(self.path, f".{key}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, os.path.join(self.path, key))
+        self.disk[key] = len(data)
+        self.disk_bytes += len(data)
+
+        while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+            name, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, id: int):
+        prefix = f"{id}-"
+        with self.lock:
+            for key in [k for k in self.memory if k.startswith(prefix)]:
+                self.memory_bytes -= len(self.memory.pop(key))
+            for key in [k for k in self.disk if k.startswith(prefix)]:
+                self.disk_bytes -= self.disk.pop(key)
+                try:
+                    os.remove(os.path.join(self.path, key))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, memory_bytes=self.memory_bytes, disk_bytes=self.disk_bytes)
+
+    def _put_memory(self, key: str, data: bytes):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
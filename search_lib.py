@@ -1,11 +1,40 @@
 import codecs
 import ctypes
+import itertools
 import json
+import math
+import multiprocessing
+import os
+import traceback
 import urllib.parse
 from ctypes import POINTER, c_char_p, c_uint32, c_uint8, Structure, c_bool
 from queue import Queue
-from threading import Thread
-from typing import Iterable, Optional
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Event, Lock, Thread
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+from catalog import Catalog
+from metrics import timed
+from tombstones import Tombstones
+from wal import WriteAheadLog
+
+
+INDEX_DIR = "testfile"
+INDEX_FILES = ["frequencies", "terms", "positions"]
+TOMBSTONES_PATH = f"{INDEX_DIR}/tombstones"
+# Most extra top docs fetched per segment to make up for deleted ids, before searching again with a larger fetch
+TOMBSTONE_SLACK = 64
+
+
+def remove_index_files(suffix: str):
+    for f in INDEX_FILES:
+        try:
+            os.remove(f"{INDEX_DIR}/{f}-{suffix}")
+        except FileNotFoundError:
+            pass
 
 
 class SortedKeysIndexStub(Structure):
@@ -51,16 +80,19 @@ class _SearchRetType(Structure):
             yield self.pos[i]
 
     def iter_td(self, limit=40) -> Iterable[POINTER(DocumentFrequency)]:
-        for i in list(reversed(range(0, self.topdocs_length)))[0:limit]:
+        for i in range(self.topdocs_length - 1, max(self.topdocs_length - 1 - limit, -1), -1):
             yield self.topdocs[i]
 
 
 class SearchRetType:
-    def __init__(self, dll, sr: _SearchRetType, terms: [bytes]):
+    def __init__(self, dll, sr: _SearchRetType, terms: [bytes], limit=40, min_score=0):
         td = {}
         scores = {}
         td_terms_count = {}
-        for i in sr.iter_td():
+        for i in sr.iter_td(limit):
+            if i.document_freq < min_score:
+                # topdocs are sorted by score, everything after this is lower
+                break
             td[int(i.document_id)] = []
             scores[int(i.document_id)] = i.document_freq
             td_terms_count[int(i.document_id)] = [0] * len(terms)
@@ -91,11 +123,88 @@ class SearchRetType:
     def printable(self):
         return json.dumps(dict(matches=self.matches, scores=self.scores))
 
+    @classmethod
+    def merge(cls, results: list["SearchRetType"], limit=40, offset=0,
+              deleted: Optional[Tombstones] = None) -> "SearchRetType":
+        scores = {}
+        matches = {}
+        for r in results:
+            for id, score in r.scores.items():
+                if deleted is not None and id in deleted:
+                    continue
+                if id not in scores or score > scores[id]:
+                    scores[id] = score
+                    matches[id] = r.matches[id]
+
+        top = sorted(scores, key=lambda id: scores[id], reverse=True)[offset: offset + limit]
+        merged = cls.__new__(cls)
+        merged.scores = {id: scores[id] for id in top}
+        merged.matches = {id: matches[id] for id in top}
+        return merged
+
+    @classmethod
+    def combine(cls, weighted: list[tuple["SearchRetType", float]], limit=40, offset=0,
+                min_score=0) -> "SearchRetType":
+        # Score of a document is the weighted sum of its scores for each term group, positions are concatenated.
+        scores = {}
+        matches = {}
+        for r, weight in weighted:
+            for id, score in r.scores.items():
+                scores[id] = scores.get(id, 0) + weight * score
+                matches.setdefault(id, []).extend(r.matches[id])
+
+        top = sorted((id for id in scores if scores[id] >= min_score), key=lambda id: scores[id], reverse=True)
+        top = top[offset: offset + limit]
+        combined = cls.__new__(cls)
+        combined.scores = {id: scores[id] for id in top}
+        combined.matches = {id: matches[id] for id in top}
+        return combined
+
+
+def struct_view(ptr, length: int) -> np.ndarray:
+    # Structured array over the native buffer, no copy. Only valid until free_elem_buf.
+    dtype = np.dtype(ptr._type_)
+    if length == 0 or not ptr:
+        return np.empty(0, dtype=dtype)
+    buf = (ctypes.c_char * (length * dtype.itemsize)).from_address(ctypes.cast(ptr, ctypes.c_void_p).value)
+    return np.frombuffer(buf, dtype=dtype)
+
+
+class ArraySearchRetType(SearchRetType):
+    """
+    Same results as SearchRetType, built with vectorized operations over views of the native result buffers instead of
+    one Python object per position. Only the positions of the top documents are copied out before free_elem_buf.
+    """
+
+    def __init__(self, dll, sr: _SearchRetType, terms: [bytes], limit=40, min_score=0):
+        topdocs = struct_view(sr.topdocs, sr.topdocs_length)
+        pos = struct_view(sr.pos, sr.pos_len)
+
+        # The engine returns topdocs in increasing score order.
+        top = topdocs[::-1]
+        top = top[top["document_freq"] >= min_score][0:limit]
+        self.doc_ids = top["document_id"].astype(np.int64)
+        self.doc_scores = top["document_freq"].astype(np.int64)
+
+        matched = pos[np.isin(pos["document_id"], self.doc_ids)]
+        # Stable, so every document keeps its positions in engine order.
+        matched = matched[np.argsort(matched["document_id"], kind="stable")]
+        dll.free_elem_buf(sr)
+
+        group_ids, starts = np.unique(matched["document_id"], return_index=True)
+        pairs = np.stack([matched["document_position"], matched["terms_index"]], axis=1).tolist()
+        ends = list(starts[1:]) + [len(pairs)]
+
+        self.scores = dict(zip(self.doc_ids.tolist(), self.doc_scores.tolist()))
+        self.matches = {id: [] for id in self.scores}
+        for id, start, end in zip(group_ids.tolist(), starts.tolist(), ends):
+            self.matches[id] = pairs[start:end]
+
 
 def load(path):
     indexer = ctypes.cdll.LoadLibrary(f"{path}/libgeneral-indexer.so")
     indexer.initialize_directory_variables.argtypes = [c_char_p]
-    indexer.initialize_directory_variables(b"testfile")
+    indexer.initialize_directory_variables(INDEX_DIR.encode("ascii"))
     indexer.new_index.argtypes = []
     indexer.new_index.restype = POINTER(SortedKeysIndex)
 
@@ -109,7 +218,7 @@ def load(path):
         POINTER(c_char_p),
         c_uint32,
         c_bool,
-        c_bool,
+        c_bool,  # collect term positions
     ]
 
     indexer.search_many_terms.restype = _SearchRetType
@@ -123,11 +232,19 @@ DLL = load(".")
 
 
 class Searcher:
-    def __init__(self, suffix: str):
+    def __init__(self, suffix: str, docs: int = 0):
         self.dll = DLL
         self.suffix = suffix
+        self.docs = docs
         print("Loading search ", suffix)
         self.ind = self.dll.create_index_stub(bytes(suffix, "ascii"))
+        # Reference count for CompactingIndexer: the segment list holds one reference, each in-flight search another.
+        self.refs = 1
+        self.remove_on_free = False
+        self.ref_lock = Lock()
+        # Searches on one stub take turns: the engine's thread safety per stub is unknown, and the result buffers are
+        # read until free_elem_buf. Different segments are still searched concurrently.
+        self.ffi_lock = Lock()
 
     def __enter__(self):
         return self
@@ -135,7 +252,27 @@ class Searcher:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.dll.free_index(self.ind)
 
-    def search_terms(self, *args) -> SearchRetType:
+    def acquire(self):
+        with self.ref_lock:
+            self.refs += 1
+
+    def release(self):
+        with self.ref_lock:
+            self.refs -= 1
+            free = self.refs == 0
+        if free:
+            print("Freeing search ", self.suffix)
+            self.__exit__(None, None, None)
+            self.ind = None
+            if self.remove_on_free:
+                remove_index_files(self.suffix)
+
+    def retire(self, remove_files: bool):
+        # Drops the segment list's reference, the last in-flight search frees the index.
+        self.remove_on_free = remove_files
+        self.release()
+
+    def search_terms(self, *args, vectorized=False, limit=40, min_score=0, with_positions=True) -> SearchRetType:
         terms_len = len(args)
 
         args = list(map(lambda k: bytes(k, "ascii"), args))
@@ -143,9 +280,15 @@ class Searcher:
 
         terms = ctypes.cast(terms, POINTER(c_char_p))
 
-        result = self.dll.search_many_terms(self.ind, terms, terms_len, True, True)
+        with self.ffi_lock:
+            with timed("search_many_terms"):
+                result = self.dll.search_many_terms(self.ind, terms, terms_len, True, with_positions)
 
-        return SearchRetType(self.dll, result, terms[0:terms_len])
+            # The score cut and top-k happen here, before any per-document Python objects are built.
+            with timed("search_results"):
+                if vectorized:
+                    return ArraySearchRetType(self.dll, result, terms[0:terms_len], limit, min_score)
+                return SearchRetType(self.dll, result, terms[0:terms_len], limit, min_score)
 
 
 class Indexer:
@@ -164,7 +307,8 @@ class Indexer:
         self.dll.append_file(self.ind, contents, id)
 
     def persist(self, suffix: str):
-        self.dll.persist_indices(self.ind, bytes(suffix, "ascii"))
+        with timed("persist_indices"):
+            self.dll.persist_indices(self.ind, bytes(suffix, "ascii"))
 
     def concat(self, other):
         self.dll.concat_indices(self.ind, other.ind)
@@ -181,7 +325,33 @@ class Indexer:
         pass
 
 
+def build_partial_index(docs: list[tuple[str, int]], suffix: str) -> str:
+    # Runs in a worker process of ParallelIndexer's process backend.
+    index = Indexer()
+    for contents, id in docs:
+        index.append_file(contents, id)
+    index.clean()
+    index.persist(suffix)
+    return suffix
+
+
+def tree_reduce(items: list, combine, workers: int):
+    # Combines neighbouring pairs level by level, each level's pairs in parallel. combine(a, b) returns the result.
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        while len(items) > 1:
+            pairs = [(items[i], items[i + 1]) for i in range(0, len(items) - 1, 2)]
+            merged = list(pool.map(lambda pair: combine(*pair), pairs))
+            items = merged + ([items[-1]] if len(items) % 2 else [])
+    return items[0]
+
+
 class ParallelIndexer:
+    """
+    Builds one persisted index from many documents. The "thread" backend feeds num_t in-memory Indexers from a queue
+    and merges them with a parallel pairwise concat. The "process" backend sends chunks of documents to a process
+    pool, each worker persists a partial index, and the parts are combined with libcompactor in a parallel tree.
+    """
+
     def thread_run(self, index: Indexer):
         def inner():
             while True:
@@ -194,14 +364,27 @@ class ParallelIndexer:
 
         return inner
 
-    def __init__(self, num_t=15, name="par-index"):
+    def __init__(self, num_t=15, name="par-index", backend="thread", chunk_size=5000,
+                 expected_docs: Optional[int] = None):
+        assert backend in ("thread", "process")
         self.num_t = num_t
         self.name = name
+        self.backend = backend
+        # With a known document count, one chunk per worker, so every worker gets a part however large the build.
+        self.chunk_size = max(math.ceil(expected_docs / num_t), 1) if expected_docs else chunk_size
         self.count = 0
 
     def __enter__(self):
-        self.queue = Queue(50)
         self.indices = []
+        if self.backend == "process":
+            # Not fork: callers like bulk_import have already started the merge, ingest and cache threads, and a
+            # forked worker could inherit a lock one of them held. Workers only import this module.
+            self.pool = ProcessPoolExecutor(self.num_t, mp_context=multiprocessing.get_context("forkserver"))
+            self.chunk = []
+            self.parts = []
+            return self
+
+        self.queue = Queue(50)
         for _ in range(0, self.num_t):
             ind = Indexer()
             ind.__enter__()
@@ -212,12 +395,25 @@ class ParallelIndexer:
         return self
 
     def append_file(self, contents: str, id: int):
-        self.queue.put((contents, id))
+        if self.backend == "process":
+            self.chunk.append((contents, id))
+            if len(self.chunk) >= self.chunk_size:
+                self.submit_chunk()
+        else:
+            self.queue.put((contents, id))
         self.count += 1
         if self.count % 500 == 0:
             print(self.count)
 
+    def submit_chunk(self):
+        suffix = f"{self.name}-part{len(self.parts)}"
+        self.parts.append(self.pool.submit(build_partial_index, self.chunk, suffix))
+        self.chunk = []
+
     def end(self) -> str:
+        if self.backend == "process":
+            return self.end_process()
+
         for _ in self.threads:
             self.queue.put("exit")
             self.queue.put("exit")
@@ -226,11 +422,34 @@ class ParallelIndexer:
             t.join()
 
         print("Merging")
-        for t in self.indices[1:]:
-            print("Merging")
-            self.indices[0].concat(t)
 
-        self.indices[0].persist(self.name)
+        def concat(a: Indexer, b: Indexer) -> Indexer:
+            a.concat(b)
+            return a
+
+        merged = tree_reduce(self.indices, concat, self.num_t // 2)
+        merged.persist(self.name)
+        return self.name
+
+    def end_process(self) -> str:
+        if self.chunk or not self.parts:
+            self.submit_chunk()
+        parts = [f.result() for f in self.parts]
+        self.pool.shutdown()
+
+        print("Compacting", len(parts), "parts")
+        merge_number = itertools.count()
+
+        def compact(a: str, b: str) -> str:
+            out = f"{self.name}-merge{next(merge_number)}"
+            Compactor.compact_files(a, b, out)
+            remove_index_files(a)
+            remove_index_files(b)
+            return out
+
+        merged = tree_reduce(parts, compact, self.num_t)
+        for f in INDEX_FILES:
+            os.replace(f"{INDEX_DIR}/{f}-{merged}", f"{INDEX_DIR}/{f}-{self.name}")
         return self.name
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -240,7 +459,7 @@ class ParallelIndexer:
 COMPACTORDLL = ctypes.cdll.LoadLibrary(
     "./libcompactor.so"
 )
-COMPACTORDLL.initialize_directory_variables(b"testfile")
+COMPACTORDLL.initialize_directory_variables(INDEX_DIR.encode("ascii"))
 COMPACTORDLL.compact_two_files.argtypes = [c_char_p, c_char_p, c_char_p]
 
 
@@ -248,53 +467,381 @@ class Compactor:
     @classmethod
     def compact_files(cls, a: str, b: str, out: str):
         assert a != b
-        COMPACTORDLL.compact_two_files(
-            a.encode("ascii"), b.encode("ascii"), out.encode("ascii")
-        )
+        with timed("compact_two_files"):
+            COMPACTORDLL.compact_two_files(
+                a.encode("ascii"), b.encode("ascii"), out.encode("ascii")
+            )
+
+
+class QueryCache:
+    """
+    LRU of merged search results keyed by (terms, search generation), bounded by an estimate of their size in bytes.
+    The generation changes whenever the set of searchable segments does, so entries never go stale; older generations
+    are dropped as soon as a newer one is seen.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, tuple[SearchRetType, int]] = OrderedDict()
+        self.bytes = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    @classmethod
+    def size_of(cls, result: SearchRetType) -> int:
+        # dict entries and small ints, roughly what CPython spends on them
+        return 200 + sum(150 + 80 * len(m) for m in result.matches.values())
+
+    def get(self, key: tuple) -> Optional[SearchRetType]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: tuple, result: SearchRetType):
+        size = QueryCache.size_of(result)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            generation = key[-1]
+            if generation < self.generation:
+                return
+            if generation > self.generation:
+                self.entries.clear()
+                self.bytes = 0
+                self.generation = generation
+
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (result, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / total if total else 0.0,
+                    entries=len(self.entries), bytes=self.bytes)
 
 
 class CompactingIndexer:
-    main: Optional[Searcher]
+    """
+    Index made of immutable segments. flush() persists the working index as a new segment, searches fan out over all
+    segments and merge their top docs. A background thread merges segments of similar size (size-tiered), so flush
+    cost depends on the new documents rather than on the whole index.
+
+    Segments are reference counted. A search pins the segments it started with, a merge writes a new segment file and
+    swaps it into the list, and the replaced segments are freed when their last search finishes. Searches never wait
+    for flushes or merges.
+
+    Deleted ids are kept in a tombstone bitmap and filtered out of every search. libcompactor can't drop documents,
+    so their postings stay in the segments until rebuild() writes a fresh index from the live documents.
+    """
+    segments: list[Searcher]
     count: int
+    catalog: Optional[Catalog]
+    wal: Optional[WriteAheadLog]
+    tombstones: Tombstones
 
-    def __init__(self, start_key, start_prefix):
+    def __init__(self, start_key, start_prefix, catalog: Optional[Catalog] = None,
+                 wal: Optional[WriteAheadLog] = None, tombstones: Optional[Tombstones] = None, merge_factor=4,
+                 vectorized=False, query_expander: Optional[Callable[[tuple[str]], list[tuple[str, float]]]] = None):
         print("Allocating new searcher")
-        if start_prefix:
-            self.main = Searcher(start_prefix)
+        self.vectorized = vectorized
+        # Query-time expansion: returns (word, weight) neighbours of the query terms, each searched on its own.
+        self.query_expander = query_expander
+        self.catalog = catalog
+        self.wal = wal
+        self.tombstones = tombstones or Tombstones(TOMBSTONES_PATH)
+        self.merge_factor = merge_factor
+        self.local_generation = 0
+
+        if catalog and catalog.segments:
+            self.segments = [Searcher(seg["name"], seg["docs"]) for seg in catalog.segments]
+        elif start_prefix:
+            # Index written before segments existed: a single compacted segment.
+            self.segments = [Searcher(start_prefix, catalog.row_count if catalog else 0)]
         else:
-            self.main = None
-        self.count = start_key
-        self.working = Indexer(self.count)
+            self.segments = []
 
-    def search_terms(self, terms: str) -> SearchRetType:
-        terms = urllib.parse.unquote_plus(terms).upper().split(" ")
+        self.remove_orphan_segments()
 
-        return self.main.search_terms(*terms)
+        self.count = start_key
+        self.working = Indexer(self.count)
+        self.working_docs = 0
+        # Serializes appends and flushes of the working index.
+        self.lock = Lock()
+        # Only held to read or replace the segment list, never during a search or a compaction.
+        self.segments_lock = Lock()
+        # Bumped under segments_lock every time the searchable segments change, keys the query cache.
+        self.search_generation = 0
+        self.cache = QueryCache()
+
+        self.merge_event = Event()
+        self.closed = False
+        self.merge_thread = Thread(target=self.merge_loop, name="segment-merge", daemon=True)
+        self.merge_thread.start()
+        self.merge_event.set()
+
+    def search_terms(self, terms: str, limit=40, offset=0, min_score=0, with_positions=True) -> SearchRetType:
+        terms = tuple(t for t in urllib.parse.unquote_plus(terms).upper().split(" ") if t)
+        if not terms:
+            return SearchRetType.merge([])
+
+        groups = [(terms, 1.0)]
+        if self.query_expander:
+            groups += [((word.upper(),), weight) for word, weight in self.query_expander(terms)
+                       if word.isascii() and word.isalnum()]
+
+        options = (limit, offset, min_score, with_positions)
+        key = (tuple(groups), options, self.search_generation)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        segments, generation = self.pin_segments()
+        try:
+            if len(groups) == 1:
+                result = self.search_segments(segments, terms, limit, offset, min_score, with_positions)
+            else:
+                # Each group's own top documents, with some slack since their weighted sums decide the page.
+                fetch = 2 * (offset + limit)
+                weighted = [(self.search_segments(segments, group, fetch, 0, 0, with_positions), weight)
+                            for group, weight in groups]
+                result = SearchRetType.combine(weighted, limit, offset, min_score)
+        finally:
+            for segment in segments:
+                segment.release()
+        self.cache.put(key[0:2] + (generation,), result)
+        return result
+
+    def search_segments(self, segments: list[Searcher], terms: tuple, limit: int, offset: int, min_score,
+                        with_positions: bool) -> SearchRetType:
+        # Segments hold disjoint documents, so the global page is inside the union of each segment's top
+        # offset + limit live documents.
+        want = offset + limit
+        deleted = self.tombstones if self.tombstones.count else None
+        # A few more for deleted ids. A segment that fills its fetch with fewer than `want` live ids is searched again
+        # with twice the fetch, so the cost follows the deleted ids among the top docs, not all of them.
+        fetch = want + min(self.tombstones.count, TOMBSTONE_SLACK)
+        results = []
+        while segments:
+            short = []
+            for s in segments:
+                r = s.search_terms(*terms, vectorized=self.vectorized, limit=fetch, min_score=min_score,
+                                   with_positions=with_positions)
+                if deleted is not None and len(r.scores) >= fetch and \
+                        sum(id not in deleted for id in r.scores) < want:
+                    short.append(s)
+                else:
+                    results.append(r)
+            segments = short
+            fetch *= 2
+        return SearchRetType.merge(results, limit, offset, deleted)
+
+    def pin_segments(self) -> tuple[list[Searcher], int]:
+        with self.segments_lock:
+            segments = list(self.segments)
+            for segment in segments:
+                segment.acquire()
+            return segments, self.search_generation
 
     def append_file(self, file):
-        self.count += 1
-        self.working.append_file(file, self.count)
-        return self.count
+        with self.lock:
+            self.count += 1
+            if self.wal:
+                self.wal.append_index(self.count, file)
+            self.working.append_file(file, self.count)
+            self.working_docs += 1
+            return self.count
+
+    def replay_file(self, file, id: int):
+        with self.lock:
+            self.working.append_file(file, id)
+            self.working_docs += 1
+            self.count = max(self.count, id)
+
+    def delete(self, id: int):
+        self.tombstones.add(id)
+        with self.segments_lock:
+            # Cached results may contain the id.
+            self.search_generation += 1
 
     def id_count(self):
         return self.count
 
     def name(self):
-        return self.main.suffix
+        return ",".join(s.suffix for s in self.segments)
+
+    def next_generation(self) -> int:
+        # Called from flushes and from the merge thread.
+        with self.segments_lock:
+            if self.catalog:
+                return self.catalog.next_generation()
+            self.local_generation += 1
+            return self.local_generation
+
+    def persist_manifest(self):
+        if self.catalog:
+            self.catalog.segments = [dict(name=s.suffix, docs=s.docs) for s in self.segments]
+            self.catalog.persist()
 
     def flush(self):
         print("Flushing")
-        new_suffix = "temp-index" if self.main else "main"
-        self.working.persist(new_suffix)
-        self.working.__exit__(None, None, None)
-        self.working = Indexer(self.count)
-
-        if self.main is None:
-            self.main = Searcher(new_suffix)
-        else:
-            self.main.__exit__(None, None, None)
-            Compactor.compact_files(self.main.suffix, new_suffix, "main")
-            self.main = Searcher("main")
+        with self.lock:
+            if self.working_docs:
+                new_suffix = f"seg-{self.next_generation()}"
+                self.working.persist(new_suffix)
+                self.working.__exit__(None, None, None)
+                docs = self.working_docs
+                self.working = Indexer(self.count)
+                self.working_docs = 0
+                # The working index held every appended id up to count.
+                self.add_segment(new_suffix, docs, indexed_through=self.count)
+            self.tombstones.persist()
+        self.merge_event.set()
+
+    def reserve_ids(self, n: int) -> int:
+        # For bulk loads that build their own segment: ids first..first + n - 1 are never handed out by append_file.
+        with self.lock:
+            first = self.count + 1
+            self.count += n
+            return first
+
+    def add_segment(self, suffix: str, docs: int, indexed_through: Optional[int] = None):
+        # indexed_through is only given by flush(). Bulk imported segments aren't logged, and ids below theirs may
+        # still be in the working index.
+        segment = Searcher(suffix, docs)
+        with self.segments_lock:
+            self.segments = self.segments + [segment]
+            self.search_generation += 1
+            if self.catalog and indexed_through is not None:
+                self.catalog.indexed_through = max(self.catalog.indexed_through, indexed_through)
+            self.persist_manifest()
+        self.merge_event.set()
+
+    def replace_segments(self, suffix: str, docs: int):
+        # Swaps the whole index for a rebuilt one, in-flight searches finish on the old segments.
+        segment = Searcher(suffix, docs)
+        with self.segments_lock:
+            old = self.segments
+            self.segments = [segment]
+            self.search_generation += 1
+            self.persist_manifest()
+        for s in old:
+            s.retire(remove_files=True)
+
+    def rebuild(self, documents: Iterable[tuple[str, int]], workers=os.cpu_count(), backend="thread",
+                expected_docs: Optional[int] = None) -> int:
+        # documents are (contents, id) of every live image. Deleted ids are left out, so the tombstones are purged.
+        suffix = f"seg-{self.next_generation()}"
+        with ParallelIndexer(workers, suffix, backend, expected_docs=expected_docs) as indexer:
+            for contents, id in documents:
+                if id not in self.tombstones:
+                    indexer.append_file(contents, id)
+            indexer.end()
+        self.replace_segments(suffix, indexer.count)
+        self.tombstones.clear()
+        self.tombstones.persist()
+        return indexer.count
+
+    def tier(self, segment: Searcher) -> int:
+        return int(math.log(max(segment.docs, 1), self.merge_factor))
+
+    def pick_merge(self) -> Optional[list[Searcher]]:
+        # The chosen segments are pinned like a search's, so a rebuild that replaces them mid-merge can't remove the
+        # files libcompactor is reading. merge() releases them.
+        with self.segments_lock:
+            tiers = {}
+            for segment in self.segments:
+                tiers.setdefault(self.tier(segment), []).append(segment)
+            for tier in sorted(tiers):
+                if len(tiers[tier]) >= self.merge_factor:
+                    segments = tiers[tier][0: self.merge_factor]
+                    for segment in segments:
+                        segment.acquire()
+                    return segments
+        return None
+
+    def merge_loop(self):
+        while True:
+            self.merge_event.wait()
+            self.merge_event.clear()
+            while not self.closed:
+                segments = self.pick_merge()
+                if segments is None:
+                    break
+                try:
+                    self.merge(segments)
+                except Exception:
+                    # The segments stay as they are, the next flush tries again. Partial outputs are orphans that
+                    # the next startup removes.
+                    print("Merging segments failed", [s.suffix for s in segments])
+                    traceback.print_exc()
+                    break
+            if self.closed:
+                return
+
+    def close(self):
+        # Stops the merge thread, after the merge in progress if any. Searches keep working.
+        self.closed = True
+        self.merge_event.set()
+        self.merge_thread.join()
+
+    def merge(self, segments: list[Searcher]):
+        try:
+            self.merge_pinned(segments)
+        finally:
+            for segment in segments:
+                segment.release()
+
+    def merge_pinned(self, segments: list[Searcher]):
+        new_suffix = f"seg-{self.next_generation()}"
+        print("Merging segments", [s.suffix for s in segments], "into", new_suffix)
+
+        # compact_two_files only takes two inputs, so chain through temporary outputs.
+        acc = segments[0].suffix
+        for i, segment in enumerate(segments[1:]):
+            out = new_suffix if i == len(segments) - 2 else f"{new_suffix}-part{i}"
+            Compactor.compact_files(acc, segment.suffix, out)
+            if acc != segments[0].suffix:
+                remove_index_files(acc)
+            acc = out
+
+        merged = Searcher(new_suffix, sum(s.docs for s in segments))
+        with self.segments_lock:
+            if any(s not in self.segments for s in segments):
+                # The index was replaced while merging.
+                merged.retire(remove_files=True)
+                return
+            position = self.segments.index(segments[0])
+            remaining = [s for s in self.segments if s not in segments]
+            self.segments = remaining[0:position] + [merged] + remaining[position:]
+            self.search_generation += 1
+            # The manifest switches to the new generation atomically. Until this point a crash leaves the old
+            # segments intact, and the half written new files are removed as orphans on the next startup.
+            self.persist_manifest()
+
+        for segment in segments:
+            segment.retire(remove_files=True)
+
+    def remove_orphan_segments(self):
+        live = set(s.suffix for s in self.segments)
+        orphans = set()
+        for f in os.listdir(INDEX_DIR):
+            kind, _, suffix = f.partition("-")
+            if kind in INDEX_FILES and suffix.startswith("seg-") and suffix not in live:
+                orphans.add(suffix)
+        for suffix in orphans:
+            print("Removing orphan segment", suffix)
+            remove_index_files(suffix)
 
 
 def test():
@@ -2,10 +2,25 @@ import base64
 import codecs
 import ctypes
 import dataclasses
+import functools
 import json
 import os
+import threading
 from ctypes import Structure, POINTER, c_char_p, c_uint64, c_void_p
-from typing import Union
+from typing import Iterable, Optional, Union
+
+from catalog import Catalog
+from metrics import timed
+from rwlock import RWLock
+from wal import WriteAheadLog
+
+# Column masks for TableM2 reads, one bit per column in table order. id is always selected.
+COLUMNS = ["id", "filename", "desc", "contents"]
+ALL_COLUMNS = 0b1111
+METADATA_COLUMNS = 0b0111
+CONTENTS_COLUMNS = 0b1001
+# Upper bound on one multi-row INSERT statement built by store_many
+MAX_BATCH_BYTES = 32 * 1024 * 1024
 
 
 class _TableManager(Structure):
@@ -23,9 +38,17 @@ class StrFatPtr(ctypes.Structure):
 @dataclasses.dataclass
 class ImageDocument:
     id: int
-    filename: str
-    description: bytes
-    data: bytes
+    filename: Optional[str]
+    description: Optional[bytes]
+    data: Optional[bytes]
+
+    @functools.cached_property
+    def metadata(self) -> Optional[dict]:
+        # Parsed description JSON, None for deleted images or when desc wasn't selected.
+        if self.description is None:
+            return None
+        with timed("json_loads"):
+            return json.loads(self.description)
 
 
 class FFIImageDocument(Structure):
@@ -196,23 +219,55 @@ class SQLTable:
 
 
 class TableM2:
-    def __init__(self, path):
+    catalog: Optional[Catalog]
+    wal: Optional[WriteAheadLog]
+
+    def __init__(self, path, catalog_path: Optional[str] = None, wal: Optional[WriteAheadLog] = None):
         exists = os.path.exists(path)
         if isinstance(path, str):
             path = path.encode('ascii')
         self.db = DB.sql_new(path)
         self.path = path
+        self.catalog_path = catalog_path
+        self.wal = wal
+        # Readers share the handle, stores and flushes are exclusive.
+        self.lock = RWLock()
+        # libdb2 makes no promise that one handle can run statements from several threads at once, and sql_exec
+        # returns a buffer it owns. Readers take turns inside the call; decoding the rows still runs concurrently.
+        self.ffi_lock = threading.Lock()
         if not exists:
             print("Inserting new table")
             DB.sql_exec(self.db, b"CREATE TABLE images (id INT, filename STRING, desc STRING, contents STRING)")
             DB.sql_exec(self.db, b"FLUSH")
 
+        self.catalog = self.load_catalog(catalog_path) if catalog_path else None
+
+    def load_catalog(self, catalog_path: str) -> Catalog:
+        catalog = Catalog.load(catalog_path)
+        if catalog is None:
+            # Tables written before the catalog existed: one id-only scan, then the catalog is kept up to date.
+            print("Rebuilding catalog")
+            ids = set(row[0] for row in self.exec_sql("SELECT id FROM images") or [])
+            catalog = Catalog(catalog_path, max_id=max(ids, default=0), row_count=len(ids))
+            catalog.persist()
+        return catalog
+
     def reload(self):
-        self.flush()
-        self.__init__(self.path)
+        with self.lock.write():
+            self.flush_locked()
+            # Keep the in-memory catalog object, the search index holds a reference to it.
+            catalog, lock = self.catalog, self.lock
+            self.__init__(self.path, self.catalog_path, self.wal)
+            self.catalog, self.lock = catalog, lock
 
     def flush(self):
+        with self.lock.write():
+            self.flush_locked()
+
+    def flush_locked(self):
         self.exec_sql("FLUSH")
+        if self.catalog:
+            self.catalog.persist()
 
     @classmethod
     def to_str(cls, a, b85):
@@ -225,48 +280,183 @@ class TableM2:
                 a = a.decode('ascii')
             return a
 
+    @classmethod
+    def to_sql_bytes(cls, a, b85) -> bytes:
+        if isinstance(a, str):
+            a = a.encode('ascii')
+        if b85:
+            return base64.b85encode(a)
+        return bytes(a)
+
+    @classmethod
+    def values_tuple(
+            cls,
+            id: int,
+            name: Union[bytes, str],
+            description: Union[bytes, str],
+            data: Union[bytes, str],
+            b85=True
+    ) -> bytes:
+        # Built directly as bytes: the encoded blob is copied once into the statement, instead of going through
+        # str.decode, an f-string and str.encode (three more full copies of the image).
+        return b"".join((
+            b"(", str(int(id)).encode('ascii'),
+            b', "', cls.to_sql_bytes(name, b85),
+            b'", "', cls.to_sql_bytes(description, b85),
+            b'", "', cls.to_sql_bytes(data, b85),
+            b'")',
+        ))
+
+    @classmethod
+    def insert_statement(
+            cls,
+            id: int,
+            name: Union[bytes, str],
+            description: Union[bytes, str],
+            data: Union[bytes, str],
+            b85=True
+    ) -> bytes:
+        return b"INSERT INTO images VALUES " + cls.values_tuple(id, name, description, data, b85)
+
     def store(
             self,
             id: int,
             name: Union[bytes, str],
             description: Union[bytes, str],
             data: Union[bytes, str],
-            b85=True
+            b85=True,
+            log=True
     ):
-        name = TableM2.to_str(name, b85)
-        description = TableM2.to_str(description, b85)
-        data = TableM2.to_str(data, b85)
-
-        DB.sql_exec(self.db, f'INSERT INTO images VALUES ({id}, "{name}", "{description}", "{data}")'.encode('ascii'))
+        statement = TableM2.insert_statement(id, name, description, data, b85)
+        with self.lock.write():
+            if self.wal and log:
+                self.wal.append_store(id, name, description, data)
+            with timed("sql_exec"):
+                DB.sql_exec(self.db, statement)
+            if self.catalog:
+                self.catalog.record_store(id)
+
+    def store_many(self, rows: Iterable[tuple], b85=True, log=True, max_batch_bytes=MAX_BATCH_BYTES, flush=False):
+        """
+        Stores (id, name, description, data) rows with one multi-row INSERT per batch, instead of one statement per row.
+        Batches are cut at max_batch_bytes of encoded statement, so memory stays bounded for large uploads.
+        """
+        batch, batch_rows, batch_bytes = [], [], 0
+        for row in rows:
+            values = TableM2.values_tuple(*row, b85)
+            if batch and batch_bytes + len(values) > max_batch_bytes:
+                self.store_batch(batch, batch_rows, log)
+                batch, batch_rows, batch_bytes = [], [], 0
+            batch.append(values)
+            batch_rows.append(row)
+            batch_bytes += len(values)
+        self.store_batch(batch, batch_rows, log)
+
+        if flush:
+            self.flush()
+
+    def store_batch(self, batch: list[bytes], rows: list[tuple], log: bool):
+        if not batch:
+            return
+        statement = b"INSERT INTO images VALUES " + b", ".join(batch)
+        with self.lock.write():
+            if self.wal and log:
+                for row in rows:
+                    self.wal.append_store(*row)
+            with timed("sql_exec"):
+                DB.sql_exec(self.db, statement)
+            if self.catalog:
+                for row in rows:
+                    self.catalog.record_store(row[0])
 
     def exec_sql(self, q: str):
-        ret = DB.sql_exec(self.db, q.encode('ascii'))
+        # c_char_p results are copied into a Python bytes object before the lock is released.
+        with self.ffi_lock, timed("sql_exec"):
+            ret = DB.sql_exec(self.db, q.encode('ascii'))
         if ret:
-            ret = json.loads(ret)
+            with timed("json_loads"):
+                ret = json.loads(ret)
         return ret
 
-    def process_list(self, li):
+    @classmethod
+    def projection(cls, mask: int) -> list[str]:
+        return [c for bit, c in enumerate(COLUMNS) if bit == 0 or mask & (1 << bit)]
+
+    def select(self, mask: int, where: str = "", limit: Optional[int] = None) -> list[ImageDocument]:
+        columns = TableM2.projection(mask)
+        q = f'SELECT {", ".join(columns)} FROM images'
+        if where:
+            q += f" WHERE {where}"
+        if limit is not None:
+            q += f" LIMIT {int(limit)}"
+        with self.lock.read():
+            rows = self.exec_sql(q)
+        return self.process_list(rows, columns)
+
+    def process_list(self, li, columns=COLUMNS):
+        with timed("b85decode"):
+            return self.decode_rows(li, columns)
+
+    def decode_rows(self, li, columns):
         retli = {}
-        seen = set()
-        for i in li:
+        for i in li or []:
             if i[0] not in retli:
-                retli[i[0]] = ImageDocument(i[0], base64.b85decode(i[1]).decode('ascii'), base64.b85decode(i[2]),
-                                            base64.b85decode(i[3]))
+                row = dict(zip(columns, i))
+                retli[i[0]] = ImageDocument(
+                    i[0],
+                    base64.b85decode(row["filename"]).decode('ascii') if "filename" in row else None,
+                    base64.b85decode(row["desc"]) if "desc" in row else None,
+                    base64.b85decode(row["contents"]) if "contents" in row else None,
+                )
         return list(retli.values())
 
-    def get(self, id: int, mask=0):
-        ret = self.exec_sql(f'SELECT id, filename, desc, contents FROM images WHERE id EQUALS {id}')
-        return self.process_list(ret)[0]
+    def get(self, id: int, mask=ALL_COLUMNS) -> Optional[ImageDocument]:
+        ret = self.select(mask, f"id EQUALS {int(id)}")
+        return ret[0] if ret else None
 
-    def get_by_name(self, name: str):
-        name = TableM2.to_str(name, True)
-        ret = self.exec_sql(f'SELECT * FROM images WHERE filename EQUALS "{name}"')
-        return self.process_list(ret)
-
-    def load_first_n(self, n: int):
-        ret = self.exec_sql('SELECT * FROM images')
+    def get_many(self, ids: list[int], mask=METADATA_COLUMNS) -> dict[int, ImageDocument]:
+        if not ids:
+            return {}
+        id_list = ", ".join(str(int(id)) for id in ids)
+        return {doc.id: doc for doc in self.select(mask, f"id IN ({id_list})")}
 
-        return self.process_list(ret)[0:n]
+    def get_by_name(self, name: str, mask=ALL_COLUMNS):
+        name = TableM2.to_str(name, True)
+        return self.select(mask, f'filename EQUALS "{name}"')
+
+    def load_first_n(self, n: int, mask=METADATA_COLUMNS):
+        return self.select(mask, limit=n)[0:n]
+
+    def compact(self, batch_size=1000):
+        """
+        Rewrites the table with only the current version of each live image, dropping deleted rows and overwritten
+        versions. Deleted rows whose bytes a live duplicate still points at are kept. Callers must hold off other
+        writers.
+        """
+        metadata = self.select(0b0101)
+        ids = sorted(d.id for d in metadata)
+        referenced = set(d.metadata["blob"] for d in metadata if d.metadata and "blob" in d.metadata)
+        temp_path = self.path + b".compact"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        compacted = TableM2(temp_path)
+
+        live = 0
+        for i in range(0, len(ids), batch_size):
+            docs = self.get_many(ids[i: i + batch_size], ALL_COLUMNS).values()
+            rows = [(d.id, d.filename, d.description, d.data) for d in docs
+                    if d.metadata is not None or d.id in referenced]
+            compacted.store_many(rows, log=False)
+            live += len(rows)
+        compacted.flush()
+        print("Compacted table from", len(ids), "to", live, "images")
+
+        with self.lock.write():
+            os.replace(temp_path, self.path)
+            self.db = DB.sql_new(self.path)
+            if self.catalog:
+                self.catalog.row_count = live
+                self.catalog.persist()
 
     def tui(self):
         while True:
@@ -1,10 +1,18 @@
+import hashlib
 import io
+import json
+import os
 import random
+import time
 
 import flask
+from PIL import Image
 
 import DB
+import picture
 from api import flush_search
+from picture import MODEL, NeighbourCache, expand_tags_batch, build_neighbour_table, model_fingerprint, WEBP_SUPPORTED
+from table_manager import ALL_COLUMNS, METADATA_COLUMNS, CONTENTS_COLUMNS, TableM2
 
 
 def fill_with_images(app):
@@ -73,6 +81,232 @@ def post_image_test(app):
             ), f"Received {received.decode('ascii', errors='ignore')} Content {content.decode('ascii', errors='ignore')}"
 
 
+def store_many_test(app):
+    with app.test_client() as client:
+        first_id = DB.SEARCH.reserve_ids(1000)
+        stored = {first_id + i: random.randbytes(2000) for i in range(0, 1000)}
+        db_data = json.dumps(dict(synonyms_desc="test image", filename="test.jpg", mimetype="image/jpeg"))
+        # Small batches, so the 1000 rows span several multi-row INSERTs
+        DB.tbm.store_many(((id, "test.jpg", db_data, content) for id, content in stored.items()),
+                          max_batch_bytes=256 * 1024, flush=True)
+
+        for id, content in stored.items():
+            received = client.get("/img_data", query_string={"id": id}).data
+            assert received == content
+
+
+def table_select_test(app):
+    # Column masks, LIMIT and filename lookups against the real libdb2 table, before and after a flush.
+    with app.test_client():
+        first_id = DB.SEARCH.reserve_ids(5)
+        stored = {first_id + i: random.randbytes(2000) for i in range(0, 5)}
+        for id, content in stored.items():
+            db_data = json.dumps(dict(synonyms_desc=f"select test {id}", filename=f"select{id}.jpg",
+                                      mimetype="image/jpeg"))
+            DB.tbm.store(id, f"select{id}.jpg", db_data, content)
+
+        for flushed in (False, True):
+            for id, content in stored.items():
+                full = DB.tbm.get(id)
+                assert (full.id, full.filename, full.data) == (id, f"select{id}.jpg", content), flushed
+                assert full.metadata["synonyms_desc"] == f"select test {id}"
+
+                metadata = DB.tbm.get(id, METADATA_COLUMNS)
+                assert metadata.filename == f"select{id}.jpg" and metadata.data is None
+                assert metadata.metadata == full.metadata
+
+                contents = DB.tbm.get(id, CONTENTS_COLUMNS)
+                assert contents.filename is None and contents.description is None and contents.data == content
+
+                [by_name] = DB.tbm.get_by_name(f"select{id}.jpg", METADATA_COLUMNS)
+                assert by_name.id == id
+
+            # id and desc only
+            selected = {doc.id: doc for doc in DB.tbm.select(0b0101)}
+            for id in stored:
+                assert selected[id].filename is None and selected[id].data is None
+                assert selected[id].metadata["synonyms_desc"] == f"select test {id}"
+
+            first = DB.tbm.load_first_n(3)
+            assert len(first) == 3
+            assert all(doc.filename is not None and doc.data is None for doc in first)
+
+            assert DB.tbm.get(DB.SEARCH.reserve_ids(1)) is None
+            DB.tbm.flush()
+
+
+def get_many_test(app):
+    # One id IN (...) select, as used by search_picture and TableM2.compact.
+    with app.test_client():
+        first_id = DB.SEARCH.reserve_ids(20)
+        stored = {first_id + i: random.randbytes(500) for i in range(0, 20)}
+        DB.tbm.store_many((id, f"many{id}.jpg", json.dumps(dict(synonyms_desc="many", filename=f"many{id}.jpg",
+                                                                  mimetype="image/jpeg")), content)
+                          for id, content in stored.items())
+        missing = DB.SEARCH.reserve_ids(1)
+
+        assert DB.tbm.get_many([]) == {}
+        for flushed in (False, True):
+            wanted = list(stored)[::2] + [missing]
+            metadata = DB.tbm.get_many(wanted)
+            assert sorted(metadata) == sorted(wanted[:-1]), flushed
+            assert all(doc.filename == f"many{id}.jpg" and doc.data is None for id, doc in metadata.items())
+
+            full = DB.tbm.get_many(list(stored), ALL_COLUMNS)
+            assert {id: doc.data for id, doc in full.items()} == stored
+            DB.tbm.flush()
+
+
+def test_wal_replay(app, init_search):
+    # Posts and a delete that only reached the WAL, then a restart that has to rebuild them from the log.
+    with app.test_client() as client:
+        flush_search()
+        posted = {}
+        for word in ("walkept", "walother", "waldeleted"):
+            content = random.randbytes(2000)
+            id = int(client.post(
+                "/post-picture-simple",
+                data={"file": (io.BytesIO(content), f"{word}.jpg"), "description": f"wal replay {word}"},
+                content_type="multipart/form-data",
+            ).data)
+            posted[word] = (id, content)
+        deleted_id = posted.pop("waldeleted")[0]
+        client.get(flask.url_for("api.delete_image"), query_string={"id": deleted_id})
+
+        # What a crash leaves behind: the table as of the last flush, and the log.
+        DB.tbm = TableM2(DB.tbm.path.decode("ascii"), DB.tbm.catalog_path, DB.WAL)
+        init_search()
+
+        assert deleted_id in DB.SEARCH.tombstones
+        assert DB.tbm.get(deleted_id, METADATA_COLUMNS).metadata is None
+        for word, (id, content) in posted.items():
+            assert DB.tbm.get(id).data == content
+            assert client.get(flask.url_for("api.img_data"), query_string={"id": id}).data == content
+
+        # Replayed index records sit in the working index until the next flush.
+        assert client.get("/flush-search").status_code == 200
+        for word, (id, _) in posted.items():
+            assert list(DB.SEARCH.search_terms(word.upper()).scores) == [id]
+        assert not DB.SEARCH.search_terms("WALDELETED").scores
+
+
+EXPANSION_TEST_TAGS = [
+    ["cat", "grass", "park", "sun"],
+    ["food", "plate", "table", "restaurant", "dinner"],
+    ["building", "sky", "city", "street", "skyscraper", "window"],
+    ["snow", "mountain", "outdoor", "nature", "ski", "winter", "tree"],
+]
+
+
+def expansion_test(app, restrict_vocab=50000):
+    # expand_tags_batch against gensim's most_similar: exact with exact=True, and how many of the 80 the candidate
+    # paths (per-tag neighbour cache, then the precomputed neighbour table) find.
+    saved_cache, saved_table = picture.NEIGHBOURS, picture.NEIGHBOUR_TABLE
+    try:
+        picture.NEIGHBOURS = NeighbourCache("testfile/neighbour-cache-test.json", model_fingerprint())
+        for tags in EXPANSION_TEST_TAGS:
+            expected = [w for w, _ in MODEL.most_similar(positive=tags, topn=80)]
+            assert expand_tags_batch([tags], exact=True)[0] == expected, tags
+            found = expand_tags_batch([tags])[0]
+            print("per-tag recall", tags, len(set(found) & set(expected)) / 80)
+            assert len(set(found) & set(expected)) >= 64, tags
+
+        picture.NEIGHBOURS = NeighbourCache("testfile/neighbour-cache-test.json", model_fingerprint())
+        picture.NEIGHBOUR_TABLE = build_neighbour_table("testfile/neighbours-test.npy", restrict_vocab=restrict_vocab)
+        for tags in EXPANSION_TEST_TAGS:
+            expected = [w for w, _ in MODEL.most_similar(positive=tags, topn=80, restrict_vocab=restrict_vocab)]
+            found = expand_tags_batch([tags])[0]
+            print("table recall", tags, len(set(found) & set(expected)) / 80)
+            assert len(set(found) & set(expected)) >= 64, tags
+    finally:
+        picture.NEIGHBOURS, picture.NEIGHBOUR_TABLE = saved_cache, saved_table
+        for path in ("testfile/neighbour-cache-test.json", "testfile/neighbours-test.npy"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def vectorized_search_test(app):
+    # ArraySearchRetType must build the same results as SearchRetType, in the same order.
+    words = ["alpine", "watermelon", "harbour", "lantern", "meadow", "violin"]
+    with app.test_client() as client:
+        for i in range(0, 60):
+            description = " ".join(random.choice(words) for _ in range(random.randint(3, 12)))
+            client.post(
+                "/post-picture-simple",
+                data={"file": (io.BytesIO(random.randbytes(100)), "test.jpg"), "description": description},
+                content_type="multipart/form-data",
+            )
+        assert client.get("/flush-search").status_code == 200
+
+        queries = [("ALPINE",), ("WATERMELON", "MEADOW"), ("HARBOUR", "LANTERN", "VIOLIN"), ("NOTAWORD",)]
+        options = [dict(), dict(limit=5), dict(min_score=4), dict(with_positions=False),
+                   dict(limit=10, min_score=2, with_positions=False)]
+        for segment in DB.SEARCH.segments:
+            for terms in queries:
+                for option in options:
+                    plain = segment.search_terms(*terms, vectorized=False, **option)
+                    vectorized = segment.search_terms(*terms, vectorized=True, **option)
+                    assert list(plain.scores.items()) == list(vectorized.scores.items()), (terms, option)
+                    assert plain.matches == vectorized.matches, (terms, option)
+
+
+def http_cache_test(app):
+    # ETags, 304s and Range requests of /img_data, all answered by the test client.
+    image = io.BytesIO()
+    Image.new("RGB", (800, 600), (30, 120, 200)).save(image, format="JPEG")
+    content = image.getvalue()
+    with app.test_client() as client:
+        id = int(client.post(
+            "/post-picture-simple",
+            data={"file": (io.BytesIO(content), "cache.jpg"), "description": "http cache test"},
+            content_type="multipart/form-data",
+        ).data)
+
+        response = client.get("/img_data", query_string={"id": id})
+        assert response.status_code == 200 and response.data == content
+        etag = response.headers["ETag"]
+        assert etag == f'"{id}-{hashlib.sha256(content).hexdigest()[0:16]}"'
+        assert "immutable" in response.headers["Cache-Control"]
+        assert response.headers["Accept-Ranges"] == "bytes"
+
+        revalidated = client.get("/img_data", query_string={"id": id}, headers={"If-None-Match": etag})
+        assert revalidated.status_code == 304 and revalidated.data == b""
+        assert revalidated.headers["ETag"] == etag
+
+        partial = client.get("/img_data", query_string={"id": id}, headers={"Range": "bytes=0-9"})
+        assert partial.status_code == 206 and partial.data == content[0:10]
+        assert partial.headers["Content-Range"] == f"bytes 0-9/{len(content)}"
+
+        etags = {etag}
+        for size in ("thumb", "medium"):
+            for accept in ("image/jpeg", "image/webp"):
+                rendition = client.get("/img_data", query_string={"id": id, "size": size}, headers={"Accept": accept})
+                assert rendition.status_code == 200
+                assert "Accept" in rendition.headers["Vary"]
+                etags.add(rendition.headers["ETag"])
+                assert client.get("/img_data", query_string={"id": id, "size": size},
+                                  headers={"Accept": accept, "If-None-Match": rendition.headers["ETag"]}
+                                  ).status_code == 304
+        # full, and thumb and medium in each format the server can produce
+        assert len(etags) == (5 if WEBP_SUPPORTED else 3)
+
+
+def benchmark_search_modes(app, queries=("snow", "family", "food", "building", "dog park"), repeat=20):
+    # Latency of /search-results with the text index against the vector index, over the same queries.
+    with app.test_client() as client:
+        for mode in ("text", "vector"):
+            times = []
+            for _ in range(0, repeat):
+                for query in queries:
+                    start = time.perf_counter()
+                    response = client.get("/search-results", query_string={"query": query, "mode": mode})
+                    times.append(time.perf_counter() - start)
+                    assert response.status_code == 200
+            times.sort()
+            print(f"{mode}: p50 {times[len(times) // 2] * 1000:.2f}ms p99 {times[int(len(times) * 0.99)] * 1000:.2f}ms "
+                  f"over {len(times)} searches, {len(DB.VECTORS)} vectors")
+
+
 def search_image_test(app):
     with app.test_client() as client:
         id_alpine = int(
@@ -97,7 +331,7 @@ def search_image_test(app):
         )
 
         assert client.get("/flush-search").status_code == 200
-        print(DB.SEARCH.main)
+        print(DB.SEARCH.name())
         assert [id_alpine] == list(DB.SEARCH.search_terms("ALPINE").scores.keys())
         assert [id_watermelon] == list(
             DB.SEARCH.search_terms("WATERMELON").scores.keys()
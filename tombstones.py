@@ -0,0 +1,56 @@
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+
+
+class Tombstones:
+    """
+    Bitmap of deleted image ids, one bit per id, persisted next to the search index. Searches drop these ids before
+    results are hydrated, until a compaction purges them from the table and the index.
+    """
+
+    def __init__(self, path: str, bits: Optional[np.ndarray] = None):
+        self.path = path
+        self.bits = bits if bits is not None else np.zeros(0, dtype=np.uint8)
+        self.count = int(np.unpackbits(self.bits).sum())
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Tombstones"]:
+        try:
+            return cls(path, np.fromfile(path, dtype=np.uint8))
+        except FileNotFoundError:
+            return None
+
+    def add(self, id: int):
+        with self.lock:
+            byte, bit = divmod(id, 8)
+            if byte >= len(self.bits):
+                # Grow geometrically, ids only increase.
+                grown = np.zeros(max(byte + 1, 2 * len(self.bits)), dtype=np.uint8)
+                grown[0: len(self.bits)] = self.bits
+                self.bits = grown
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                self.count += 1
+
+    def __contains__(self, id: int) -> bool:
+        byte, bit = divmod(id, 8)
+        bits = self.bits
+        return byte < len(bits) and bool(bits[byte] & (1 << bit))
+
+    def clear(self):
+        with self.lock:
+            self.bits = np.zeros(0, dtype=np.uint8)
+            self.count = 0
+
+    def persist(self):
+        with self.lock:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(self.bits.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
@@ -0,0 +1,152 @@
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+
+# Rows added per resize of the memory mapped files
+MIN_CAPACITY = 1024
+
+
+class VectorIndex:
+    """
+    One unit length embedding per image in a memory mapped float32 matrix, row = image id, searched by cosine
+    similarity. Searches are brute force until build_ivf() clusters the vectors; after that a search only scores the
+    nprobe closest clusters, plus whatever was appended since the clustering.
+    """
+
+    def __init__(self, path: str, dim: int, nprobe=8):
+        self.path = path
+        self.dim = dim
+        self.nprobe = nprobe
+        # Serializes appends and resizes. Searches use whatever arrays were current when they started.
+        self.lock = threading.Lock()
+
+        capacity = 0
+        if os.path.exists(self.matrix_path()):
+            capacity = os.path.getsize(self.matrix_path()) // (4 * dim)
+        self.matrix: Optional[np.memmap] = None
+        self.valid: Optional[np.memmap] = None
+        self.capacity = 0
+        if capacity:
+            self.open(capacity)
+
+        self.ivf = None
+        if os.path.exists(self.ivf_path()):
+            with np.load(self.ivf_path()) as ivf:
+                self.ivf = dict(ivf)
+
+    def matrix_path(self) -> str:
+        return f"{self.path}.f32"
+
+    def valid_path(self) -> str:
+        return f"{self.path}-valid.u8"
+
+    def ivf_path(self) -> str:
+        return f"{self.path}-ivf.npz"
+
+    def open(self, capacity: int):
+        for path, itemsize in ((self.matrix_path(), 4 * self.dim), (self.valid_path(), 1)):
+            with open(path, "ab") as f:
+                f.truncate(capacity * itemsize)
+        self.matrix = np.memmap(self.matrix_path(), dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self.valid = np.memmap(self.valid_path(), dtype=np.uint8, mode="r+", shape=(capacity,))
+        self.capacity = capacity
+
+    def append(self, id: int, vector: np.ndarray):
+        with self.lock:
+            if id >= self.capacity:
+                if self.matrix is not None:
+                    self.flush_locked()
+                # Grow geometrically, older arrays stay valid for searches still using them.
+                self.open(max(id + 1, 2 * self.capacity, MIN_CAPACITY))
+            self.matrix[id] = vector / np.linalg.norm(vector)
+            self.valid[id] = 1
+
+    def remove(self, id: int):
+        with self.lock:
+            if id < self.capacity:
+                self.valid[id] = 0
+
+    def __len__(self) -> int:
+        return 0 if self.valid is None else int(np.count_nonzero(self.valid))
+
+    def search(self, query: np.ndarray, limit=40, offset=0) -> list[tuple[int, float]]:
+        matrix, valid, ivf = self.matrix, self.valid, self.ivf
+        if matrix is None:
+            return []
+        query = (query / np.linalg.norm(query)).astype(np.float32)
+
+        if ivf is not None:
+            ids = self.probe(ivf, query, len(valid))
+            ids = ids[valid[ids] == 1]
+            scores = matrix[ids] @ query
+        else:
+            scores = np.asarray(matrix @ query)
+            ids = np.flatnonzero(valid)
+            scores = scores[ids]
+
+        k = min(offset + limit, len(ids))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")][offset:]
+        return list(zip(ids[top].tolist(), scores[top].tolist()))
+
+    def probe(self, ivf: dict, query: np.ndarray, size: int) -> np.ndarray:
+        # Ids in the nprobe closest clusters, and every id appended after the clustering.
+        centroids, ids, starts = ivf["centroids"], ivf["ids"], ivf["starts"]
+        nprobe = min(self.nprobe, len(centroids))
+        closest = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+        lists = [ids[starts[c]: starts[c + 1]] for c in closest]
+        lists.append(np.arange(int(ivf["built_through"]) + 1, size))
+        return np.concatenate(lists)
+
+    def build_ivf(self, nlist: Optional[int] = None, iterations=10, chunk=65536, seed=0):
+        """
+        Spherical k-means over the stored vectors, nlist defaults to sqrt(n). Saved next to the matrix and picked up
+        by searches once written.
+        """
+        with self.lock:
+            self.flush_locked()
+            matrix, valid = self.matrix, self.valid
+        if matrix is None:
+            return
+        ids = np.flatnonzero(valid)
+        if len(ids) == 0:
+            return
+        nlist = min(nlist or max(int(np.sqrt(len(ids))), 1), len(ids))
+        rng = np.random.default_rng(seed)
+        centroids = np.array(matrix[rng.choice(ids, nlist, replace=False)])
+
+        assignment = np.zeros(len(ids), dtype=np.int64)
+        for iteration in range(iterations):
+            sums = np.zeros_like(centroids)
+            counts = np.zeros(nlist, dtype=np.int64)
+            for start in range(0, len(ids), chunk):
+                vectors = matrix[ids[start: start + chunk]]
+                nearest = np.argmax(vectors @ centroids.T, axis=1)
+                assignment[start: start + len(nearest)] = nearest
+                np.add.at(sums, nearest, vectors)
+                counts += np.bincount(nearest, minlength=nlist)
+            # Empty clusters keep their old centroid.
+            filled = counts > 0
+            centroids[filled] = sums[filled] / np.linalg.norm(sums[filled], axis=1, keepdims=True)
+            print("IVF iteration", iteration + 1, "/", iterations)
+
+        order = np.argsort(assignment, kind="stable")
+        starts = np.searchsorted(assignment[order], np.arange(nlist + 1))
+        ivf = dict(centroids=centroids, ids=ids[order], starts=starts, built_through=np.int64(ids[-1]))
+        temp_path = self.ivf_path() + ".tmp.npz"
+        np.savez(temp_path, **ivf)
+        os.replace(temp_path, self.ivf_path())
+        self.ivf = ivf
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.matrix is not None:
+            self.matrix.flush()
+            self.valid.flush()
@@ -0,0 +1,129 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Iterable, Union
+
+RECORD_STORE = 1
+RECORD_INDEX = 2
+
+# kind, payload length, crc32 of payload
+HEADER = struct.Struct("<BII")
+FIELD_LEN = struct.Struct("<I")
+ID = struct.Struct("<Q")
+
+
+def to_bytes(a: Union[bytes, str]) -> bytes:
+    if isinstance(a, str):
+        return a.encode("utf8")
+    return a
+
+
+class WriteAheadLog:
+    """
+    Append-only log of table stores and index appends that haven't been flushed yet. Writers append, then commit();
+    concurrent commits share a single fsync (group commit). The log is truncated by checkpoint() once the table and the
+    search index have both been flushed.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, max_seconds=300):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.file = open(path, "ab")
+        self.cond = threading.Condition()
+        self.written = self.file.tell()
+        self.synced = self.written
+        self.syncing = False
+        self.last_checkpoint = time.monotonic()
+
+    def append(self, kind: int, *fields: bytes) -> int:
+        parts = []
+        for f in fields:
+            parts.append(FIELD_LEN.pack(len(f)))
+            parts.append(f)
+        payload = b"".join(parts)
+        with self.cond:
+            self.file.write(HEADER.pack(kind, len(payload), zlib.crc32(payload)))
+            self.file.write(payload)
+            self.written = self.file.tell()
+            return self.written
+
+    def append_store(self, id: int, name, description, data) -> int:
+        return self.append(RECORD_STORE, ID.pack(id), to_bytes(name), to_bytes(description), to_bytes(data))
+
+    def append_index(self, id: int, contents) -> int:
+        return self.append(RECORD_INDEX, ID.pack(id), to_bytes(contents))
+
+    def commit(self, lsn: int = None):
+        with self.cond:
+            if lsn is None:
+                lsn = self.written
+            while self.synced < lsn:
+                if self.syncing:
+                    # Another thread is already fsyncing, our record is either covered by it or by the next one.
+                    self.cond.wait()
+                    continue
+
+                self.syncing = True
+                target = self.written
+                self.file.flush()
+                fd = self.file.fileno()
+                self.cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self.cond.acquire()
+                    self.syncing = False
+                self.synced = max(self.synced, target)
+                self.cond.notify_all()
+
+    def should_checkpoint(self) -> bool:
+        if self.written >= self.max_bytes:
+            return True
+        return self.written > 0 and time.monotonic() - self.last_checkpoint >= self.max_seconds
+
+    def checkpoint(self):
+        with self.cond:
+            self.file.truncate(0)
+            self.file.seek(0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.written = self.synced = 0
+            self.last_checkpoint = time.monotonic()
+
+    def replay(self) -> Iterable[tuple]:
+        with open(self.path, "rb") as f:
+            valid_end = 0
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                kind, length, crc = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    print("Torn WAL record at", valid_end, ", ignoring the rest of the log")
+                    break
+                valid_end = f.tell()
+                yield kind, WriteAheadLog.decode(kind, payload)
+
+        if valid_end != self.written:
+            with self.cond:
+                self.file.truncate(valid_end)
+                self.file.seek(valid_end)
+                self.written = self.synced = valid_end
+
+    @classmethod
+    def decode(cls, kind: int, payload: bytes) -> tuple:
+        fields = []
+        offset = 0
+        while offset < len(payload):
+            (length,) = FIELD_LEN.unpack_from(payload, offset)
+            offset += FIELD_LEN.size
+            fields.append(payload[offset: offset + length])
+            offset += length
+        (id,) = ID.unpack(fields[0])
+        if kind == RECORD_STORE:
+            return id, fields[1].decode("utf8"), fields[2], fields[3]
+        return id, fields[1]